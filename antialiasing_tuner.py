@@ -0,0 +1,219 @@
+import argparse
+import json
+import logging
+import statistics
+import struct
+import time
+import requests
+import urllib3
+from update_antialiasing import get_token, get_service_info, update_service
+from server_comparison_report import get_service_names
+
+# ignore warning about NGDC-signed certificate
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# from cheapest to most expensive. Best is the reference the others are compared with
+MODES = ['None', 'Fastest', 'Fast', 'Normal', 'Best']
+
+# seconds to wait for a service to come back after its antialiasingMode is changed
+RESTART_TIMEOUT = 120
+
+
+def main(args):
+    token = get_token(args.username, args.password, args.server)
+
+    if args.services:
+        services = args.services
+    else:
+        services = []
+        get_service_names(f"{args.server}:6443", services, None, 'MapServer')
+
+    extents = args.bbox or ['-170,-85,170,85']
+    desired = []
+    report = []
+    for name in services:
+        try:
+            measurements = tune_service(token, args.server, name, extents, args.size, args.requests)
+        except Exception as e:
+            logging.error(f"unable to tune {name}: {e}")
+            continue
+        if measurements is None:
+            continue
+
+        recommended = recommend_mode(measurements, args.threshold)
+        logging.info(f"{name}: recommend {recommended}. " + ', '.join(
+            f"{mode} {m['seconds']:.3f}s diff {m['difference']:.4f}" for mode, m in measurements.items()))
+        desired.append({'name': name, 'antialiasing': recommended})
+        report.append({'name': name, 'antialiasing': recommended, 'measurements': measurements})
+
+    # desired-state list for update_antialiasing.py --targets
+    with open(args.output, 'w') as json_file:
+        json.dump(desired, json_file, indent=2)
+    logging.info(f"wrote {len(desired)} services to {args.output}")
+
+    if args.report:
+        with open(args.report, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+def tune_service(token, servername, servicename, extents, size='800,600', repeat=3):
+    """
+    render each extent under each antialiasing mode, returning {mode: {'seconds': median render time,
+    'difference': mean pixel difference from Best}}. The service's original mode is put back afterwards
+    """
+    service_info = get_service_info(token, servername, servicename)
+    original = service_info['properties'].get('antialiasingMode')
+    if original is None:
+        # e.g. built-in SampleWorldCities doesn't have antialiasingMode property
+        logging.warning(f"{servicename} has no antialiasingMode property")
+        return None
+
+    renders = {}
+    try:
+        for mode in MODES:
+            set_mode(token, servername, servicename, mode)
+            renders[mode] = [render(token, servername, servicename, bbox, size, repeat) for bbox in extents]
+    finally:
+        set_mode(token, servername, servicename, original)
+
+    measurements = {}
+    for mode in MODES:
+        seconds = [elapsed for _, times in renders[mode] for elapsed in times]
+        differences = [image_difference(image, reference[0])
+                       for (image, _), reference in zip(renders[mode], renders['Best'])]
+        measurements[mode] = {'seconds': statistics.median(seconds), 'difference': statistics.mean(differences)}
+    return measurements
+
+
+def set_mode(token, servername, servicename, mode):
+    service_info = get_service_info(token, servername, servicename)
+    if service_info['properties'].get('antialiasingMode') == mode:
+        return
+
+    service_info['properties']['antialiasingMode'] = mode
+    update_service(token, servername, servicename, service_info)
+    wait_for_service(token, servername, servicename)
+
+
+def wait_for_service(token, servername, servicename, timeout=RESTART_TIMEOUT):
+    """wait for the service to answer requests again after it's edited"""
+    url = f"https://{servername}:6443/arcgis/rest/services/{servicename}/MapServer"
+    deadline = time.time() + timeout
+    while True:
+        try:
+            r = requests.get(url, params={'f': 'json', 'token': token}, verify=False, timeout=30)
+            if r.status_code == 200 and 'error' not in r.json():
+                return
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        if time.time() > deadline:
+            raise Exception(f"{servicename} did not come back within {timeout}s")
+        time.sleep(2)
+
+
+def render(token, servername, servicename, bbox, size='800,600', repeat=3):
+    """
+    export the extent as a BMP, uncompressed so encoding doesn't dominate the time. Returns the decoded image and the
+    seconds taken by each request, after a first request to warm up the service
+    """
+    url = f"https://{servername}:6443/arcgis/rest/services/{servicename}/MapServer/export"
+    params = {'bbox': bbox, 'bboxSR': '4326', 'size': size, 'dpi': '96', 'format': 'bmp', 'transparent': 'false',
+              'f': 'image', 'token': token}
+
+    times = []
+    content = None
+    for i in range(repeat + 1):
+        start = time.perf_counter()
+        r = requests.get(url, params=params, verify=False, timeout=120)
+        elapsed = time.perf_counter() - start
+        if r.status_code != 200 or not r.headers.get('Content-Type', '').startswith('image/'):
+            raise Exception(f"export of {servicename} failed: {r.text[:200]}")
+        content = r.content
+        if i:
+            times.append(elapsed)
+
+    return decode_bmp(content), times
+
+
+def decode_bmp(content):
+    """returns (width, height, RGB bytes) of an uncompressed 8, 24 or 32 bit BMP"""
+    if content[:2] != b'BM':
+        raise Exception("not a BMP image")
+
+    pixel_offset, = struct.unpack_from('<I', content, 10)
+    header_size, width, height, _, bits, compression = struct.unpack_from('<IiiHHI', content, 14)
+    # 32 bit images may use bitfields, assumed to be the usual BGRA masks
+    if compression not in (0, 3):
+        raise Exception(f"unsupported BMP compression {compression}")
+
+    palette = None
+    if bits == 8:
+        colors_used, = struct.unpack_from('<I', content, 46)
+        palette_offset = 14 + header_size
+        palette = [content[palette_offset + 4 * i:palette_offset + 4 * i + 3][::-1] for i in range(colors_used or 256)]
+    elif bits not in (24, 32):
+        raise Exception(f"unsupported BMP bit depth {bits}")
+
+    bottom_up = height > 0
+    height = abs(height)
+    row_size = (width * bits + 31) // 32 * 4
+    rows = []
+    for y in range(height):
+        offset = pixel_offset + row_size * (height - 1 - y if bottom_up else y)
+        row = content[offset:offset + row_size]
+        if palette:
+            rows.append(b''.join(palette[index] for index in row[:width]))
+        else:
+            step = bits // 8
+            # BGR(A) to RGB
+            pixels = bytearray(width * 3)
+            pixels[0::3] = row[2:width * step:step]
+            pixels[1::3] = row[1:width * step:step]
+            pixels[2::3] = row[0:width * step:step]
+            rows.append(bytes(pixels))
+    return width, height, b''.join(rows)
+
+
+def image_difference(image, reference):
+    """mean absolute difference of the RGB channels, from 0 (identical) to 1"""
+    width, height, pixels = image
+    ref_width, ref_height, ref_pixels = reference
+    if (width, height) != (ref_width, ref_height):
+        raise Exception("images are different sizes")
+    if pixels == ref_pixels:
+        return 0.0
+    return sum(abs(a - b) for a, b in zip(pixels, ref_pixels)) / (255 * len(pixels))
+
+
+def recommend_mode(measurements, threshold=0.01):
+    """the fastest mode whose images are within the threshold of Best"""
+    acceptable = [mode for mode in MODES if measurements[mode]['difference'] <= threshold]
+    return min(acceptable, key=lambda mode: (measurements[mode]['seconds'], MODES.index(mode)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # setup command line arguments
+    arg_parser = argparse.ArgumentParser(
+        description="""measure render time and image quality of each antialiasingMode on a staging server and write
+        the recommended modes as a --targets file for update_antialiasing.py. Each service's mode is restored after
+        it's measured"""
+    )
+    arg_parser.add_argument("username", help="user name")
+    arg_parser.add_argument("password", help="password")
+    arg_parser.add_argument("server", help="fully qualified name of the staging server")
+    arg_parser.add_argument("--services", nargs='+', help="services to tune. defaults to every map service")
+    arg_parser.add_argument("--bbox", action='append',
+                            help="xmin,ymin,xmax,ymax in WGS84 of an extent to render. specify once for each extent. "
+                                 "defaults to -170,-85,170,85")
+    arg_parser.add_argument("--size", default='800,600', help="width,height of the rendered images")
+    arg_parser.add_argument("--requests", type=int, default=3, help="number of timed renders of each extent and mode")
+    arg_parser.add_argument("--threshold", type=float, default=0.01,
+                            help="largest mean pixel difference from Best, 0 to 1, of an acceptable mode")
+    arg_parser.add_argument("--output", default='antialiasing_targets.json',
+                            help="file the recommended mode of each service is written to")
+    arg_parser.add_argument("--report", help="also write the measurements to this JSON file")
+    args = arg_parser.parse_args()
+
+    main(args)
@@ -3,6 +3,28 @@ import requests
 from requests.exceptions import Timeout
 import logging
 import os
+import hashlib
+import json
+import gzip
+import bz2
+import lzma
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# files are streamed to disk under this suffix and renamed once complete
+PART_SUFFIX = '.part'
+CHUNK_SIZE = 1024 * 1024
+
+# ETag/Last-Modified of each downloaded file, used to make conditional and resumed requests
+STATE_FILENAME = '.download_state.json'
+# copy of the manifest from the last run
+MANIFEST_CACHE = '.manifest'
+
+# suffix and opener of each format files can be compressed into as they're written
+COMPRESSORS = {'gzip': ('.gz', gzip.open), 'bz2': ('.bz2', bz2.open), 'xz': ('.xz', lzma.open)}
+COMPRESSED_SUFFIXES = [suffix for suffix, _ in COMPRESSORS.values()]
 
 
 def main():
@@ -11,62 +33,330 @@ def main():
         description="""download any new OADS data files"""
     )
     arg_parser.add_argument("--dry-run", help="list files to be downloaded but no action taken", action="store_true")
+    arg_parser.add_argument("--workers", type=int, default=1, help="number of concurrent downloads")
+    arg_parser.add_argument("--max-connections", type=int, default=8,
+                            help="maximum number of open connections to each host")
+    arg_parser.add_argument("--revalidate", action="store_true",
+                            help="check files already downloaded for changes, re-downloading any which were "
+                                 "re-published")
+    arg_parser.add_argument("--compress", choices=COMPRESSORS.keys(),
+                            help="compress files as they're written, e.g. NNNNNNN_lonlat.txt.gz")
     args = arg_parser.parse_args()
 
     if args.dry_run:
         logging.info('dry_run mode: no files will be downloaded')
 
+    session = create_session(args.max_connections)
+    state = load_download_state()
+
     try:
-        file_list = get_manifest()
+        # a dry run leaves the cached manifest alone, as it's the baseline removed entries are found against
+        new_entries, changed_entries, removed_names = get_manifest_changes(session, state, args.revalidate,
+                                                                           cache=not args.dry_run)
     except Exception:
         logging.error("unable to retrieve file manifest")
         return
 
-    download_count = 0
-    for url in file_list:
-        if file_exists(url):
-            logging.debug(f'URL {url} already downloaded, no action taken')
-            continue
+    for name in removed_names:
+        logging.debug(f'{name} no longer in the manifest, no action taken')
+    logging.info(f'{len(new_entries)} new, {len(changed_entries)} changed and {len(removed_names)} removed entries '
+                 f'in the manifest')
+    new_entries.extend(changed_entries)
+
+    if args.dry_run:
+        for url, checksum in new_entries:
+            logging.debug(f'downloading {url}...')
+        logging.info(f'downloaded {len(new_entries)} new files')
+        return
+
+    counts = {'files': 0, 'bytes': 0, 'unchanged': 0}
+    counts_lock = threading.Lock()
 
+    def download(entry):
+        url, checksum = entry
         logging.debug(f'downloading {url}...')
-        if not args.dry_run:
-            try:
-                download_file(url)
-            except Exception:
-                logging.error(f"error downloading file {url}")
-                continue
+        try:
+            byte_count = download_file(url, session, checksum, get_file_state(state, url), args.compress)
+        except Exception as e:
+            logging.error(f"error downloading file {url}: {e}")
+            return
+        with counts_lock:
+            if byte_count is None:
+                counts['unchanged'] += 1
+                return
+            counts['files'] += 1
+            counts['bytes'] += byte_count
+
+    start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            executor.map(download, new_entries)
+    finally:
+        # keep the validators of partial downloads too, so they can be resumed
+        save_download_state(state)
+    elapsed = time.monotonic() - start
+
+    megabytes = counts['bytes'] / 1e6
+    rate = megabytes / elapsed if elapsed else 0
+    logging.info(f'downloaded {counts["files"]} new files ({megabytes:.1f} MB in {elapsed:.1f}s, {rate:.2f} MB/s)')
+    if args.revalidate:
+        logging.info(f'{counts["unchanged"]} files unchanged since they were downloaded')
+
+
+def create_session(max_connections=8):
+    """return a session which keeps connections alive, opening at most max_connections to any one host"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max_connections, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-        download_count = download_count + 1
 
-    logging.info(f'downloaded {download_count} new files')
+def get_manifest_changes(session=None, state=None, revalidate=False, cache=True):
+    """
+    diff the manifest against the files in DATA_DIR and the manifest from the last run. Returns the (URL, checksum)
+    entries which are new and those which changed, and the names of files dropped from the manifest. An entry has
+    changed when its checksum differs from that of the copy downloaded, or when revalidating, every entry on disk is
+    treated as changed so it gets a conditional request. A downloaded manifest replaces the cached one unless cache is
+    False
+    """
+    state = {} if state is None else state
+    previous_names = {parse_manifest_entry(line)[0].split('/')[-1] for line in read_cached_manifest()}
+    on_disk = list_data_dir()
 
+    current = {}
+    manifest, unchanged = get_manifest(session, state.setdefault(MANIFEST_CACHE, {}), cache)
+    if unchanged:
+        logging.info('manifest unchanged since the last run')
+    for line in manifest:
+        url, checksum = parse_manifest_entry(line)
+        current[url.split('/')[-1]] = (url, checksum)
 
-def file_exists(file_url):
-    filename = file_url.split('/')[-1]
-    if os.path.exists(DATA_DIR + filename):
-        return True
+    new_names = current.keys() - on_disk
+    downloaded_names = current.keys() & on_disk
+    if revalidate:
+        changed_names = downloaded_names
     else:
-        return False
+        changed_names = {name for name in downloaded_names if current[name][1] and state.get(name, {}).get('sha256')
+                         and current[name][1].lower() != state[name]['sha256']}
+        for name in changed_names:
+            # copy on disk is known to be stale, so don't let a conditional request skip it
+            state[name].pop('etag', None)
+            state[name].pop('last_modified', None)
+    removed_names = previous_names - current.keys()
 
+    return [current[name] for name in sorted(new_names)], [current[name] for name in sorted(changed_names)], \
+        sorted(removed_names)
 
-def download_file(file_url):
-    r = requests.get(file_url)
-    if r.status_code != 200:
-        raise Exception(f"error downloading file {file_url}")
 
-    filename = file_url.split('/')[-1]
-    with open(DATA_DIR + filename, 'wb') as writer:
-        writer.write(r.content)
+def list_data_dir():
+    """
+    return the set of file names in DATA_DIR, read with a single directory scan. Compressed files are listed under the
+    name of the file they hold
+    """
+    names = set()
+    with os.scandir(DATA_DIR) as it:
+        for entry in it:
+            name, suffix = os.path.splitext(entry.name)
+            names.add(name if suffix in COMPRESSED_SUFFIXES else entry.name)
+    return names
+
+
+def local_filename(file_url, compress=None):
+    """return the path the file is downloaded to, including the suffix of the compression format, if any"""
+    suffix = COMPRESSORS[compress][0] if compress else ''
+    return DATA_DIR + file_url.split('/')[-1] + suffix
+
+
+def download_file(file_url, session=None, checksum=None, file_state=None, compress=None):
+    """
+    stream the file into DATA_DIR, returning the number of bytes transferred. The file is written under a temporary
+    name and only renamed into place once it is complete and matches the expected sha256 checksum, if one is given.
+
+    file_state holds the file's ETag and Last-Modified from earlier downloads and is updated in place. When the file is
+    already on disk the request is conditional and None is returned if the server reports it unchanged. A partial file
+    left by an interrupted transfer is resumed with a Range request, as long as the server's copy hasn't changed since.
+
+    When compress names one of COMPRESSORS, the file is compressed as it's written. The checksum still applies to the
+    uncompressed content, but compressed transfers can't be resumed
+    """
+    file_state = {} if file_state is None else file_state
+    filename = local_filename(file_url, compress)
+    part_filename = filename + PART_SUFFIX
+    opener = COMPRESSORS[compress][1] if compress else open
+    # a partial compressed stream can't be appended to
+    resumable = not compress
+
+    headers = {}
+    if os.path.exists(filename):
+        if file_state.get('etag'):
+            headers['If-None-Match'] = file_state['etag']
+        if file_state.get('last_modified'):
+            headers['If-Modified-Since'] = file_state['last_modified']
+
+    offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+    part_validator = file_state.get('part_etag') or file_state.get('part_last_modified')
+    if offset and part_validator and resumable:
+        headers['Range'] = f'bytes={offset}-'
+        # server sends the whole file instead if it changed since the partial transfer started
+        headers['If-Range'] = part_validator
+
+    with (session or requests).get(file_url, headers=headers, stream=True, timeout=(10, 60)) as r:
+        if r.status_code == 304:
+            return None
+
+        if r.status_code == 206 and 'Range' in headers:
+            mode = 'ab'
+        elif r.status_code == 200:
+            mode = 'wb'
+            offset = 0
+            file_state['part_etag'] = r.headers.get('ETag')
+            file_state['part_last_modified'] = r.headers.get('Last-Modified')
+        elif r.status_code == 416:
+            # partial file no longer matches the server's copy, start again from scratch next time
+            os.remove(part_filename)
+            raise Exception(f"unable to resume download of {file_url}")
+        else:
+            raise Exception(f"error downloading file {file_url}")
+
+        digest = file_digest(part_filename) if mode == 'ab' else hashlib.sha256()
+        byte_count = 0
+        try:
+            with opener(part_filename, mode) as writer:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    writer.write(chunk)
+                    digest.update(chunk)
+                    byte_count += len(chunk)
+            fsync(part_filename)
+
+            # Content-Length counts the encoded bytes when the response is compressed in transit
+            expected_length = r.headers.get('Content-Length')
+            if expected_length and 'Content-Encoding' not in r.headers and int(expected_length) != byte_count:
+                raise Exception(f"truncated download of {file_url}: {byte_count} of {expected_length} bytes")
+        except BaseException:
+            # keep what was transferred if there's a validator to resume it with
+            if not (resumable and (file_state.get('part_etag') or file_state.get('part_last_modified'))):
+                os.remove(part_filename)
+            raise
+
+        if checksum and digest.hexdigest() != checksum.lower():
+            os.remove(part_filename)
+            raise Exception(f"checksum mismatch for {file_url}")
 
+    os.replace(part_filename, filename)
+    remove_other_copies(file_url, compress)
+    file_state['sha256'] = digest.hexdigest()
+    file_state['etag'] = file_state.pop('part_etag', None)
+    file_state['last_modified'] = file_state.pop('part_last_modified', None)
+    return byte_count
 
-def get_manifest():
-    """returns a list of data file URLs"""
-    r = requests.get(MANIFEST_URL)
+
+def fsync(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def remove_other_copies(file_url, compress=None):
+    """remove any copy of the file stored with a different compression, so it isn't loaded twice"""
+    for other in [None, *COMPRESSORS]:
+        if other == compress:
+            continue
+        try:
+            os.remove(local_filename(file_url, other))
+        except FileNotFoundError:
+            pass
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def load_download_state():
+    """return the dictionary of filename: ETag/Last-Modified saved by the last run"""
+    try:
+        with open(DATA_DIR + STATE_FILENAME) as reader:
+            return json.load(reader)
+    except FileNotFoundError:
+        return {}
+
+
+def save_download_state(state):
+    with open(DATA_DIR + STATE_FILENAME + PART_SUFFIX, 'w') as writer:
+        json.dump(state, writer, indent=1)
+    os.replace(DATA_DIR + STATE_FILENAME + PART_SUFFIX, DATA_DIR + STATE_FILENAME)
+
+
+def get_file_state(state, file_url):
+    return state.setdefault(file_url.split('/')[-1], {})
+
+
+def parse_manifest_entry(line):
+    """return the (URL, sha256 checksum) from a manifest line. The checksum is an optional second column"""
+    fields = line.split()
+    return fields[0], fields[1] if len(fields) > 1 else None
+
+
+def get_manifest(session=None, manifest_state=None, cache=True):
+    """
+    returns an iterator over the data file URL lines of the manifest, streamed as it downloads, and whether the manifest
+    is unchanged since the last run. An unchanged manifest is read from the copy cached in DATA_DIR instead, and a
+    downloaded one replaces that copy unless cache is False
+    """
+    manifest_state = {} if manifest_state is None else manifest_state
+    headers = {}
+    if os.path.exists(DATA_DIR + MANIFEST_CACHE):
+        if manifest_state.get('etag'):
+            headers['If-None-Match'] = manifest_state['etag']
+        if manifest_state.get('last_modified'):
+            headers['If-Modified-Since'] = manifest_state['last_modified']
+
+    r = (session or requests).get(MANIFEST_URL, headers=headers, stream=True, timeout=(10, 60))
+    if r.status_code == 304:
+        r.close()
+        return read_cached_manifest(), True
 
     if r.status_code != 200:
+        r.close()
         raise Exception("unable to retrieve file manifest")
 
-    return r.text.splitlines()
+    manifest_state['etag'] = r.headers.get('ETag')
+    manifest_state['last_modified'] = r.headers.get('Last-Modified')
+    return (cache_manifest(r) if cache else iter_manifest(r)), False
+
+
+def iter_manifest(response):
+    """yield each line of the manifest response"""
+    response.encoding = response.encoding or 'utf-8'
+    with response:
+        for line in response.iter_lines(decode_unicode=True):
+            if line.strip():
+                yield line
+
+
+def cache_manifest(response):
+    """yield each line of the manifest response, saving a copy for the next run once every line has been read"""
+    with open(DATA_DIR + MANIFEST_CACHE + PART_SUFFIX, 'w') as writer:
+        for line in iter_manifest(response):
+            writer.write(line + '\n')
+            yield line
+    os.replace(DATA_DIR + MANIFEST_CACHE + PART_SUFFIX, DATA_DIR + MANIFEST_CACHE)
+
+
+def read_cached_manifest():
+    try:
+        with open(DATA_DIR + MANIFEST_CACHE) as reader:
+            for line in reader:
+                if line.strip():
+                    yield line.rstrip('\n')
+    except FileNotFoundError:
+        return
 
 
 if __name__ == "__main__":
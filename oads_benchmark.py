@@ -0,0 +1,252 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from itertools import islice
+import oads_points_loader
+
+# stand-in for the Oracle points table
+POINTS_SCHEMA = """CREATE TABLE IF NOT EXISTS oads_points (
+    lon REAL NOT NULL,
+    lat REAL NOT NULL,
+    accession_id TEXT NOT NULL,
+    line_number INTEGER NOT NULL
+)"""
+
+# malformed lines mixed into the generated files. each is rejected by get_coordinates
+BAD_LINES = ('-999.0000\t12.3456', '12.3456', 'lon\tlat', '', '12.3456\t-95.0000')
+
+STAGES = ('parse', 'filter', 'insert', 'load_points')
+
+
+def main():
+    # setup command line arguments
+    arg_parser = argparse.ArgumentParser(
+        description="""time parsing, filtering and inserting generated OADS points files"""
+    )
+    arg_parser.add_argument("--rows", type=int, nargs='+', default=[10000, 100000, 1000000],
+                            help="number of rows in each generated file, e.g. --rows 10000 50000000")
+    arg_parser.add_argument("--duplicate-rate", type=float, default=0.1,
+                            help="fraction of rows repeating the previous point")
+    arg_parser.add_argument("--bad-rate", type=float, default=0.01, help="fraction of malformed rows")
+    arg_parser.add_argument("--seed", type=int, default=1, help="seed for the generated tracklines")
+    arg_parser.add_argument("--repeat", type=int, default=3,
+                            help="number of times each file is timed. the fastest run of each stage is reported")
+    arg_parser.add_argument("--work-dir", help="directory for the generated files, which are reused by later runs. "
+                                               "defaults to a temporary directory")
+    arg_parser.add_argument("--db", default=':memory:', help="SQLite file standing in for the points table")
+    arg_parser.add_argument("--output", default='oads_benchmark.json', help="file the results are written to")
+    arg_parser.add_argument("--baseline", help="results from an earlier run to compare against")
+    arg_parser.add_argument("--threshold", type=float, default=1.1,
+                            help="report a regression when a stage takes this many times as long as the baseline")
+    args = arg_parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='oads_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    for row_count in args.rows:
+        filename = generate_file(work_dir, row_count, args.duplicate_rate, args.bad_rate, args.seed)
+        result = benchmark_file(filename, row_count, args.repeat, args.db)
+        results.append(result)
+        logging.info(f"{row_count} rows: " + ', '.join(
+            f"{stage} {result[stage + '_seconds']:.3f}s ({result[stage + '_rows_per_second']:.0f} rows/s)"
+            for stage in STAGES
+        ))
+
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'batch_size': oads_points_loader.BATCH_SIZE,
+        'tolerance': oads_points_loader.TOLERANCE,
+        'duplicate_rate': args.duplicate_rate,
+        'bad_rate': args.bad_rate,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results
+    }
+    with open(args.output, 'w') as writer:
+        json.dump(report, writer, indent=2)
+    logging.info(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as reader:
+            baseline = json.load(reader)
+        regressions = compare_results(baseline['results'], results, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+def generate_file(work_dir, row_count, duplicate_rate, bad_rate, seed=1):
+    """
+    write a trackline of row_count tab-separated lon/lat rows, e.g. NNNNNNN_lonlat.txt. A ship wanders from a random
+    start, some rows repeat the previous point and some are malformed. An existing file for the same settings is reused
+    """
+    filename = f"{work_dir}/{row_count:07d}_lonlat.txt"
+    settings_filename = filename + '.json'
+    settings = {'rows': row_count, 'duplicate_rate': duplicate_rate, 'bad_rate': bad_rate, 'seed': seed}
+    try:
+        with open(settings_filename) as reader:
+            if json.load(reader) == settings and os.path.exists(filename):
+                return filename
+    except FileNotFoundError:
+        pass
+
+    logging.info(f"generating {filename}...")
+    rng = random.Random(seed)
+    lon = rng.uniform(-180, 180)
+    lat = rng.uniform(-60, 60)
+    lines = []
+    with open(filename, 'w') as writer:
+        for _ in range(row_count):
+            draw = rng.random()
+            if draw < bad_rate:
+                lines.append(rng.choice(BAD_LINES))
+            else:
+                if draw >= bad_rate + duplicate_rate:
+                    # roughly 1km between fixes, turning back at the poles and wrapping at the antimeridian
+                    lon += rng.uniform(-0.01, 0.01)
+                    lat += rng.uniform(-0.01, 0.01)
+                    lon = (lon + 180) % 360 - 180
+                    lat = max(-89.0, min(89.0, lat))
+                lines.append(f"{lon:.4f}\t{lat:.4f}")
+
+            if len(lines) >= oads_points_loader.BATCH_SIZE:
+                writer.write('\n'.join(lines) + '\n')
+                lines = []
+        if lines:
+            writer.write('\n'.join(lines) + '\n')
+
+    with open(settings_filename, 'w') as writer:
+        json.dump(settings, writer)
+    return filename
+
+
+def benchmark_file(filename, row_count, repeat=3, db=':memory:'):
+    """time each stage of loading the file, keeping the fastest of repeat runs"""
+    result = {'rows': row_count, 'file_bytes': os.path.getsize(filename)}
+    for _ in range(repeat):
+        timings, counts = time_stages(filename, db)
+        timings['load_points'] = time_load_points(filename, db)
+        for stage, seconds in timings.items():
+            key = stage + '_seconds'
+            result[key] = min(seconds, result.get(key, seconds))
+    result.update(counts)
+
+    for stage in STAGES:
+        seconds = result[stage + '_seconds']
+        result[stage + '_rows_per_second'] = row_count / seconds if seconds else 0.0
+    return result
+
+
+def time_stages(filename, db):
+    """
+    return the seconds spent parsing, filtering and inserting the file's rows, and the row counts. The file is read a
+    batch at a time and each batch goes through the three stages in turn, as it does in load_points
+    """
+    timings = {'parse': 0.0, 'filter': 0.0, 'insert': 0.0}
+    counts = {'loaded_rows': 0, 'bad_rows': 0, 'duplicate_rows': 0}
+    accession_id = oads_points_loader.get_accession_id_from_filename(filename)
+    connection = open_points_db(db)
+    prev_coords = None
+
+    # a bad row is logged as an error. logging every one would swamp the timings
+    logging.disable(logging.ERROR)
+    try:
+        points = oads_points_loader.parse_file(filename)
+        while True:
+            start = time.perf_counter()
+            rows = list(islice(points, oads_points_loader.BATCH_SIZE))
+            timings['parse'] += time.perf_counter() - start
+            if not rows:
+                break
+
+            start = time.perf_counter()
+            batch = []
+            for _, line_number, coords in rows:
+                if coords is None:
+                    counts['bad_rows'] += 1
+                    continue
+                if oads_points_loader.point_within_tolerance(prev_coords, coords):
+                    counts['duplicate_rows'] += 1
+                    continue
+                prev_coords = coords
+                batch.append((coords[0], coords[1], accession_id, line_number))
+            timings['filter'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            insert_points(connection, batch)
+            timings['insert'] += time.perf_counter() - start
+            counts['loaded_rows'] += len(batch)
+    finally:
+        logging.disable(logging.NOTSET)
+        connection.close()
+
+    return timings, counts
+
+
+def time_load_points(filename, db):
+    """return the seconds load_points takes end to end, inserting into the SQLite stand-in"""
+    connection = open_points_db(db)
+    insert_rows = oads_points_loader.insert_rows
+    oads_points_loader.insert_rows = lambda batch: insert_points(connection, batch)
+    logging.disable(logging.ERROR)
+    try:
+        start = time.perf_counter()
+        oads_points_loader.load_points(filename)
+        return time.perf_counter() - start
+    finally:
+        logging.disable(logging.NOTSET)
+        oads_points_loader.insert_rows = insert_rows
+        connection.close()
+
+
+def open_points_db(db):
+    connection = sqlite3.connect(db)
+    connection.execute(POINTS_SCHEMA)
+    connection.execute("DELETE FROM oads_points")
+    connection.commit()
+    return connection
+
+
+def insert_points(connection, batch):
+    """insert and commit a batch of (lon, lat, accession id, line number) rows"""
+    with connection:
+        connection.executemany("INSERT INTO oads_points (lon, lat, accession_id, line_number) VALUES (?, ?, ?, ?)",
+                               batch)
+
+
+def compare_results(baseline_results, results, threshold=1.1):
+    """log each stage's change from the baseline for the same row count, returning the stages which regressed"""
+    baseline_by_rows = {result['rows']: result for result in baseline_results}
+    regressions = []
+    for result in results:
+        baseline = baseline_by_rows.get(result['rows'])
+        if baseline is None:
+            continue
+
+        for stage in STAGES:
+            key = stage + '_seconds'
+            if not baseline.get(key):
+                continue
+            ratio = result[key] / baseline[key]
+            if ratio > threshold:
+                regressions.append((result['rows'], stage))
+                logging.warning(f"{result['rows']} rows: {stage} took {ratio:.2f}x as long as the baseline")
+            else:
+                logging.info(f"{result['rows']} rows: {stage} took {ratio:.2f}x as long as the baseline")
+    return regressions
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import logging
+import os
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import download_oads_files
+import oads_points_loader
+
+# marks the end of a queue's input
+DONE = None
+
+
+def main():
+    # setup command line arguments
+    arg_parser = argparse.ArgumentParser(
+        description="""download any new OADS data files and load their points as soon as each download completes"""
+    )
+    arg_parser.add_argument("--manifest-url", default='https://data.nodc.noaa.gov/ncei/ocaa/ocaa_lonlat.url',
+                            help="URL of the list of data file URLs")
+    arg_parser.add_argument("--data-dir", default='./oads/', help="directory the data files are downloaded into")
+    arg_parser.add_argument("--ledger", help="SQLite file recording the files already loaded. defaults to "
+                                             "load_ledger.sqlite in the data directory")
+    arg_parser.add_argument("--download-workers", type=int, default=4, help="number of concurrent downloads")
+    arg_parser.add_argument("--max-connections", type=int, default=8,
+                            help="maximum number of open connections to each host")
+    arg_parser.add_argument("--compress", choices=download_oads_files.COMPRESSORS.keys(),
+                            help="compress files as they're downloaded, e.g. NNNNNNN_lonlat.txt.gz")
+    arg_parser.add_argument("--workers", type=int, default=4, help="number of processes parsing and filtering files")
+    arg_parser.add_argument("--writers", type=int, default=4, help="maximum number of concurrent DB writer connections")
+    arg_parser.add_argument("--queue-size", type=int, default=100, help="maximum number of files waiting in each stage")
+    arg_parser.add_argument("--tolerance", type=float, default=oads_points_loader.TOLERANCE,
+                            help="skip a point when both longitude and latitude are within this many degrees of the "
+                                 "previous point")
+    arg_parser.add_argument("--grid-resolution", type=float,
+                            help="size in degrees of the cells of each accession's occupancy grid. no grid by default")
+    arg_parser.add_argument("--partition-dir",
+                            help="also write the loaded points into this directory, partitioned by web mercator tile")
+    arg_parser.add_argument("--partition-zoom", type=int, default=6, help="zoom level of the partition tiles")
+    arg_parser.add_argument("--db-username", help="database user name")
+    arg_parser.add_argument("--db-password", help="database password")
+    arg_parser.add_argument("--db-host", help="database hostname")
+    arg_parser.add_argument("--db-name", help="database name")
+    args = arg_parser.parse_args()
+
+    # both scripts keep their settings in module globals
+    download_oads_files.MANIFEST_URL = args.manifest_url
+    download_oads_files.DATA_DIR = oads_points_loader.DATA_DIR = args.data_dir
+    oads_points_loader.db_connect_string = f"{args.db_username}/{args.db_password}@{args.db_host}/{args.db_name}"
+
+    ledger_path = args.ledger or args.data_dir + 'load_ledger.sqlite'
+    try:
+        ledger = oads_points_loader.open_ledger(ledger_path)
+    except Exception:
+        logging.error("unable to open the load ledger")
+        return
+
+    loaded_accessions = oads_points_loader.get_loaded_accessions(ledger)
+
+    url_queue = queue.Queue(maxsize=args.queue_size)
+    load_queue = queue.Queue(maxsize=args.queue_size)
+    download_counts = {'downloaded': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+    session = download_oads_files.create_session(args.max_connections)
+    download_state = download_oads_files.load_download_state()
+
+    # files already on disk but not loaded, e.g. from an earlier run which stopped after downloading them
+    pending_files = oads_points_loader.get_new_files(ledger)
+
+    threading.Thread(target=read_manifest, args=(url_queue, session, download_state, args.download_workers),
+                     daemon=True).start()
+    producers = [threading.Thread(target=queue_files, args=(pending_files, load_queue), daemon=True)]
+    for _ in range(args.download_workers):
+        producers.append(threading.Thread(
+            target=download_stage, daemon=True,
+            args=(url_queue, load_queue, session, download_state, args.compress, loaded_accessions, download_counts,
+                  counts_lock)
+        ))
+    for producer in producers:
+        producer.start()
+    threading.Thread(target=close_queue, args=(producers, load_queue), daemon=True).start()
+
+    try:
+        load_options = {'tolerance': args.tolerance, 'grid_resolution': args.grid_resolution,
+                        'partition_dir': args.partition_dir, 'partition_zoom': args.partition_zoom}
+        file_count, total_point_count = load_stage(load_queue, ledger_path, args.workers, args.writers,
+                                                   **load_options)
+    finally:
+        download_oads_files.save_download_state(download_state)
+
+    logging.info(f"downloaded {download_counts['downloaded']} new files, {download_counts['failed']} failed")
+    logging.info(f"loaded {total_point_count} points from {file_count} files")
+
+
+def read_manifest(url_queue, session, download_state, download_workers):
+    """queue each new or changed manifest entry, followed by an end marker for each download worker"""
+    try:
+        new_entries, changed_entries, _ = download_oads_files.get_manifest_changes(session, download_state)
+        for entry in new_entries + changed_entries:
+            url_queue.put(entry)
+    except Exception:
+        logging.error("unable to retrieve file manifest")
+    finally:
+        for _ in range(download_workers):
+            url_queue.put(DONE)
+
+
+def download_stage(url_queue, load_queue, session, download_state, compress, loaded_accessions, counts, counts_lock):
+    """download each queued URL and pass the file on to the load stage"""
+    while True:
+        entry = url_queue.get()
+        if entry is DONE:
+            return
+
+        url, checksum = entry
+        logging.debug(f'downloading {url}...')
+        try:
+            download_oads_files.download_file(url, session, checksum,
+                                              download_oads_files.get_file_state(download_state, url), compress)
+        except Exception as e:
+            logging.error(f"error downloading file {url}: {e}")
+            with counts_lock:
+                counts['failed'] += 1
+            continue
+
+        with counts_lock:
+            counts['downloaded'] += 1
+
+        filename = download_oads_files.local_filename(url, compress)
+        name = filename.split('/')[-1]
+        stat = os.stat(filename)
+        # an accession in the ledger has been downloaded again, so its points are replaced
+        accession_id = oads_points_loader.get_accession_id_from_filename(name)
+        load_queue.put(oads_points_loader.file_entry(name, stat.st_size, stat.st_mtime_ns,
+                                                     reload=accession_id in loaded_accessions))
+
+
+def queue_files(entries, load_queue):
+    for entry in entries:
+        load_queue.put(entry)
+
+
+def close_queue(producers, load_queue):
+    """mark the end of the load queue once every thread feeding it has finished"""
+    for producer in producers:
+        producer.join()
+    load_queue.put(DONE)
+
+
+def load_stage(load_queue, ledger_path, workers, writers, **load_options):
+    """
+    load each queued file in a process pool, keeping at most two files per worker in flight. Returns the number of
+    files and points loaded
+    """
+    counts = {'files': 0, 'points': 0}
+    # workers are started while the download threads are running, so they mustn't be forked from this process
+    context = multiprocessing.get_context('forkserver')
+    slots = context.BoundedSemaphore(writers)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(slots, oads_points_loader.db_connect_string,
+                                       logging.getLogger().level)) as executor:
+        in_flight = {}
+        queued_accessions = set()
+        while True:
+            entry = load_queue.get()
+            if entry is DONE:
+                break
+
+            accession_id = entry['accession_id']
+            if accession_id in queued_accessions:
+                # e.g. a file left by an earlier run which has since been downloaded again, possibly compressed. It's
+                # loaded once the earlier load of the accession has finished, replacing that load's points
+                for future in [future for future, loading in in_flight.items()
+                               if loading['accession_id'] == accession_id]:
+                    wait([future])
+                    record_result(future, in_flight.pop(future), counts)
+                entry['reload'] = True
+            queued_accessions.add(accession_id)
+
+            future = executor.submit(oads_points_loader.load_file, entry, ledger_path, **load_options)
+            in_flight[future] = entry
+            # wait for a file to finish when the pool is saturated. completed files are recorded as they're found
+            done, _ = wait(in_flight, timeout=None if len(in_flight) >= 2 * workers else 0,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                record_result(future, in_flight.pop(future), counts)
+
+        for future in list(in_flight):
+            record_result(future, in_flight.pop(future), counts)
+
+    return counts['files'], counts['points']
+
+
+def init_worker(slots, connect_string, log_level):
+    # a worker started from the forkserver doesn't inherit this process's logging configuration
+    logging.basicConfig(level=log_level)
+    oads_points_loader.init_worker(slots, connect_string)
+
+
+def record_result(future, entry, counts):
+    file = entry['filename']
+    error = future.exception()
+    if error:
+        print(error)
+        logging.error(f"failed to load points from file {file}")
+        return
+
+    # the worker which loaded the file has recorded it in the ledger
+    entry = future.result()
+    logging.info(f"loaded {entry['row_count']} points from file {file}")
+    counts['files'] += 1
+    counts['points'] += entry['row_count']
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    main()
@@ -4,6 +4,107 @@ from requests.exceptions import Timeout
 import logging
 import os
 import glob
+import hashlib
+import math
+import gzip
+import bz2
+import lzma
+import io
+import mmap
+import struct
+from array import array
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# bounds the number of concurrent DB writers when files are loaded in a process pool. set in each worker process
+writer_slots = None
+
+# Oracle connect string of the points table, also set in each worker process. The connection is opened on first use
+db_connect_string = None
+db_connection = None
+
+# one row per loaded point, replaced an accession at a time when its file is reloaded. LINE_NUMBER is the point's line
+# in the text file, or its number in the sidecar it was read from
+POINTS_TABLE = 'OADS_POINTS'
+
+LEDGER_SCHEMA = """CREATE TABLE IF NOT EXISTS load_ledger (
+    filename TEXT PRIMARY KEY,
+    accession_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    loaded_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+)"""
+
+# progress through a partially loaded file, written after each committed batch. byte_offset is NULL when the points were
+# read from the file's sidecar, line_number then being the number of sidecar points read
+CHECKPOINT_SCHEMA = """CREATE TABLE IF NOT EXISTS load_checkpoint (
+    filename TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    byte_offset INTEGER,
+    line_number INTEGER NOT NULL,
+    prev_lon REAL,
+    prev_lat REAL,
+    loaded_points INTEGER NOT NULL,
+    bad_points INTEGER NOT NULL,
+    duplicate_points INTEGER NOT NULL
+)"""
+
+# extent and counts of each accession's loaded points, so catalog and map-extent queries don't scan the points. grid
+# is an optional occupancy bitmap of grid_resolution degree cells, in rows from -90 and columns from -180. complete is 0
+# while the accession's file is partially loaded
+SUMMARY_SCHEMA = """CREATE TABLE IF NOT EXISTS accession_summary (
+    accession_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    min_lon REAL,
+    min_lat REAL,
+    max_lon REAL,
+    max_lat REAL,
+    loaded_points INTEGER NOT NULL,
+    duplicate_points INTEGER NOT NULL,
+    bad_points INTEGER NOT NULL,
+    grid_resolution REAL,
+    grid BLOB,
+    complete INTEGER NOT NULL
+)"""
+
+# points in each web mercator tile of an optional partitioned export, one row per accession and tile. Each tile's points
+# are stored as longitude, latitude pairs of little-endian doubles in <partition dir>/<zoom>/<x>/<y>/<accession>.pts
+PARTITION_SCHEMA = """CREATE TABLE IF NOT EXISTS partition_index (
+    accession_id TEXT NOT NULL,
+    zoom INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    point_count INTEGER NOT NULL,
+    min_lon REAL NOT NULL,
+    min_lat REAL NOT NULL,
+    max_lon REAL NOT NULL,
+    max_lat REAL NOT NULL,
+    PRIMARY KEY (accession_id, zoom, x, y)
+)"""
+
+# web mercator doesn't extend past these latitudes, points beyond go in the first or last row of tiles
+MAX_MERCATOR_LAT = 85.0511287798
+
+BATCH_SIZE = 5000
+
+# compressed files are decompressed as they're read, e.g. NNNNNNN_lonlat.txt.gz
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+DATA_SUFFIXES = ('.txt',) + tuple('.txt' + suffix for suffix in COMPRESSED_OPENERS)
+
+# bytes of a memory-mapped file split into lines at a time
+READ_CHUNK_SIZE = 1024 * 1024
+
+TOLERANCE = 0.0001  # ~11m at equator
+
+# binary cache of the valid points parsed from a text file, written next to it as e.g. NNNNNNN_lonlat.txt.pts. A header
+# of magic, point count, bad point count and sha256 of the text file (padded to keep the coordinates 8-byte aligned) is
+# followed by the longitude, latitude pairs as little-endian doubles
+SIDECAR_SUFFIX = '.pts'
+SIDECAR_MAGIC = b'OADSPTS1'
+SIDECAR_HEADER = struct.Struct('<8sQQ32s8x')
 
 
 def main():
@@ -12,30 +113,61 @@ def main():
         description="""insert into Oracle table points from any file not currently represented in the database"""
     )
     arg_parser.add_argument("--dry-run", help="list files to be loaded but no action taken", action="store_true")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="number of processes used to parse and load files. defaults to 1 (no process pool)")
+    arg_parser.add_argument("--writers", type=int, default=4,
+                            help="maximum number of concurrent DB writer connections when --workers > 1")
+    arg_parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                            help="skip a point when both longitude and latitude are within this many degrees of the "
+                                 "previous point")
+    arg_parser.add_argument("--reprocess", action="store_true",
+                            help="reload every file, including those already loaded, e.g. after changing --tolerance")
+    arg_parser.add_argument("--grid-resolution", type=float,
+                            help="size in degrees of the cells of each accession's occupancy grid. no grid by default")
+    arg_parser.add_argument("--partition-dir",
+                            help="also write the loaded points into this directory, partitioned by web mercator tile")
+    arg_parser.add_argument("--partition-zoom", type=int, default=6, help="zoom level of the partition tiles")
+    arg_parser.add_argument("--ledger", help="SQLite file recording the files already loaded. defaults to "
+                                             "load_ledger.sqlite in the data directory")
+    arg_parser.add_argument("--db-username", help="database user name")
+    arg_parser.add_argument("--db-password", help="database password")
+    arg_parser.add_argument("--db-host", help="database hostname")
+    arg_parser.add_argument("--db-name", help="database name")
     args = arg_parser.parse_args()
 
     if args.dry_run:
         logging.info('dry_run mode: no files will be loaded')
 
+    global db_connect_string
+    db_connect_string = f"{args.db_username}/{args.db_password}@{args.db_host}/{args.db_name}"
+
+    ledger_path = args.ledger or DATA_DIR + 'load_ledger.sqlite'
     try:
-        current_accessions = get_accession_ids()
+        ledger = open_ledger(ledger_path)
     except Exception:
-        logging.error("unable to retrieve existing accession IDs")
+        logging.error("unable to open the load ledger")
         return
 
-    # files on disk w/o corresponding accession ID in database
-    new_files = get_new_files(current_accessions)
+    # files on disk which are not in the ledger or have changed since they were loaded
+    new_files = get_new_files(ledger, args.reprocess)
+
+    if args.dry_run:
+        for entry in new_files:
+            logging.info(f"would load file {entry['filename']}")
+        return
 
     # counters
     file_count = 0
     total_point_count = 0
-    for file in new_files:
-        try:
-            point_count = load_points(file)
-        except Exception as e:
-            print(e)
+    load_options = {'tolerance': args.tolerance, 'grid_resolution': args.grid_resolution,
+                    'partition_dir': args.partition_dir, 'partition_zoom': args.partition_zoom}
+    for entry, error in load_files(new_files, args.workers, args.writers, ledger_path, **load_options):
+        file = entry['filename']
+        if error:
+            print(error)
             logging.error(f"failed to load points from file {file}")
             continue
+        point_count = entry['row_count']
         logging.info(f"loaded {point_count} points from file {file}")
         total_point_count += point_count
         file_count += 1
@@ -43,61 +175,513 @@ def main():
     logging.info(f"loaded {total_point_count} points from {file_count} files")
 
 
-def read_large_file(file_handler):
-    for line in file_handler:
-        yield line.strip()
+def load_files(entries, workers=1, writers=4, ledger_path=None, **load_options):
+    """
+    load each file entry, yielding an (entry, error) tuple as each one finishes. With more than one worker, files are
+    parsed and filtered in a process pool and at most `writers` processes hold a DB connection at the same time.
+    load_options are passed on to load_points
+    """
+    if workers <= 1:
+        for entry in entries:
+            try:
+                yield load_file(entry, ledger_path, **load_options), None
+            except Exception as e:
+                yield entry, e
+        return
+
+    slots = multiprocessing.BoundedSemaphore(writers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(slots, db_connect_string)) as executor:
+        futures = {executor.submit(load_file, entry, ledger_path, **load_options): entry for entry in entries}
+        for future in as_completed(futures):
+            try:
+                yield future.result(), None
+            except Exception as e:
+                yield futures[future], e
+
 
+def load_file(entry, ledger_path=None, **load_options):
+    """
+    checksum and load a single file, returning its entry updated with the checksum and row count. Progress is
+    checkpointed in the ledger, if given, so a failed load resumes where it left off on the next run, and the finished
+    load is recorded there
+    """
+    if not entry['sha256']:
+        entry['sha256'] = file_checksum(entry['filename'])
 
-def load_points(filename):
+    ledger = open_ledger(ledger_path) if ledger_path else None
+    try:
+        entry['row_count'] = load_points(entry['filename'], entry['reload'], ledger, entry['sha256'], entry=entry,
+                                         **load_options)
+    finally:
+        if ledger:
+            ledger.close()
+    return entry
+
+
+def init_worker(slots, connect_string=None):
+    global writer_slots, db_connect_string
+    writer_slots = slots
+    db_connect_string = connect_string
+
+
+def read_lines(file_handler, offset=0):
+    """
+    yield a (byte offset following the line, line) tuple for each line of a binary file, starting at offset. Regular
+    files are memory-mapped, anything which can't be mapped falls back to buffered reads
+    """
+    try:
+        mapped = mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError, io.UnsupportedOperation):
+        # empty files and streams can't be mapped
+        return read_large_file(file_handler, offset)
+    return read_mapped_file(mapped, offset)
+
+
+def read_mapped_file(mapped, offset=0):
+    """
+    split a memory-mapped file into lines a chunk at a time. Each chunk ends on a newline, so lines are sliced straight
+    out of the mapping without the per-line read, decode and strip of iterating a text file
+    """
+    with mapped:
+        size = len(mapped)
+        while offset < size:
+            end = min(offset + READ_CHUNK_SIZE, size)
+            if end < size:
+                # back up to the last newline in the chunk, or extend to the next one if the line is longer than a chunk
+                end = mapped.rfind(b'\n', offset, end) + 1 or mapped.find(b'\n', end) + 1 or size
+
+            lines = mapped[offset:end].split(b'\n')
+            # empty when the chunk ends with a newline, otherwise the unterminated last line of the file
+            last = lines.pop()
+            for line in lines:
+                offset += len(line) + 1
+                yield offset, line
+            if last:
+                offset = end
+                yield offset, last
+
+
+def read_large_file(file_handler, offset=0):
+    """yield a (byte offset following the line, line) tuple for each line of a binary file, starting at offset"""
+    file_handler.seek(offset)
+    for line in file_handler:
+        offset += len(line)
+        yield offset, line.strip()
+
+
+def load_points(filename, reload=False, ledger=None, sha256=None, tolerance=TOLERANCE, grid_resolution=None,
+                partition_dir=None, partition_zoom=6, entry=None):
+    """
+    load the points from a file, skipping bad and duplicate points. When given the file's checksum, points are read
+    from the binary sidecar left by an earlier load of the same content, otherwise a sidecar is written during this
+    load. When given a ledger connection, a checkpoint is written after each batch parsed from the text file and a
+    previously interrupted load resumes from its checkpoint. The accession's summary is also kept in the ledger.
+    When given a partition directory, the loaded points are also written there partitioned by web mercator tile. The
+    file entry, if given, is recorded in the ledger's load_ledger table once the file is loaded
+    """
     count = 0
     bad_points = 0
     duplicate_points = 0
+    valid_points = 0
 
+    offset = 0
+    line_number = 0
     prev_coords = None
     batch = []
 
     accession_id = get_accession_id_from_filename(filename)
 
-    with open(filename, 'r') as reader:
-        for cnt, line in enumerate(read_large_file(reader), start=1):
-            try:
-                coords = get_coordinates(cnt, line)
-            except Exception as error:
-                logging.error(error)
+    summary = new_summary(grid_resolution)
+    partitions = new_partitions(partition_dir, partition_zoom) if partition_dir else None
+    checkpoint = get_checkpoint(ledger, filename, sha256) if ledger else None
+    if checkpoint and checkpoint[0] is None and not read_sidecar_header(filename, sha256):
+        # the sidecar an interrupted load was reading has gone, so the file is loaded again from the start
+        checkpoint = None
+        reload = True
+    if checkpoint:
+        offset, line_number, prev_coords, count, bad_points, duplicate_points = checkpoint
+        summary = get_partial_summary(ledger, filename, grid_resolution) or summary
+        if partitions:
+            restore_partitions(ledger, accession_id, partitions)
+        # points of a batch committed after the checkpoint was saved would otherwise be inserted twice
+        with_writer_slot(delete_rows, accession_id, line_number)
+        position = 'line' if offset is not None else 'sidecar point'
+        logging.info(f"resuming {filename} at {position} {line_number + 1}")
+    else:
+        if reload:
+            # file was re-published, replace the points loaded from the previous version. The ledger no longer
+            # vouches for them first, so a load which fails part way is retried by the next run
+            if ledger:
+                with ledger:
+                    invalidate_load(ledger, accession_id)
+            with_writer_slot(delete_rows, accession_id)
+        # a reload without a partition directory still drops the index of the old points
+        if partitions or reload:
+            clear_partitions(ledger, accession_id, partitions)
+
+    # a load interrupted while parsing the text file is finished from it, since its checkpoint is a byte offset into it
+    from_text = checkpoint and offset is not None
+    header = read_sidecar_header(filename, sha256) if sha256 and not from_text else None
+    sidecar_writer = None
+    sidecar_points = array('d')
+    if header:
+        points_in_sidecar, bad_points = header
+        points = read_sidecar(filename, points_in_sidecar, line_number)
+    else:
+        points = parse_file(filename, offset, line_number)
+        if sha256:
+            sidecar_writer = create_sidecar(filename)
+        if sidecar_writer and checkpoint:
+            # the lines before the checkpoint are parsed again, but not loaded, so the sidecar is still complete
+            valid_points = rebuild_sidecar_prefix(sidecar_writer, filename, offset)
+            if valid_points is None:
+                discard_sidecar(sidecar_writer, filename)
+                sidecar_writer = None
+                valid_points = 0
+
+    try:
+        for offset, cnt, coords in points:
+            if coords is None:
                 bad_points += 1
                 continue
 
-            if point_within_tolerance(prev_coords, coords):
+            if sidecar_writer:
+                valid_points += 1
+                sidecar_points.extend(coords)
+                if len(sidecar_points) >= 2 * BATCH_SIZE:
+                    sidecar_points.tofile(sidecar_writer)
+                    del sidecar_points[:]
+
+            if point_within_tolerance(prev_coords, coords, tolerance):
                 duplicate_points += 1
                 continue
 
             prev_coords = coords
+            add_to_summary(summary, coords)
+            if partitions:
+                add_to_partitions(partitions, coords)
             coords.append(accession_id)
+            coords.append(cnt)
             batch.append(coords)
 
-            # TODO batch size may be inconsistent if duplicate or bad points encountered. Replace row number with
-            #  independent counter that accounts for skipped rows in batch size test
-            if (cnt % 5000) == 0:
-                # print(f"row number: {cnt}, batch size: {len(batch)}")
-                insert_rows(batch)
+            if len(batch) >= BATCH_SIZE:
+                write_batch(batch)
                 count += len(batch)
                 batch = []
+                if partitions:
+                    flush_partitions(partitions, accession_id)
+                if ledger:
+                    with ledger:
+                        save_checkpoint(ledger, filename, sha256, offset, cnt, prev_coords, count, bad_points,
+                                        duplicate_points)
+                        save_summary(ledger, filename, summary, count, bad_points, duplicate_points, complete=False)
+                        if partitions:
+                            save_partition_index(ledger, accession_id, partitions)
 
         # add the last (partial) batch
-        insert_rows(batch)
+        write_batch(batch)
         count += len(batch)
+        if partitions:
+            flush_partitions(partitions, accession_id)
 
-        logging.info(f"bad points: {bad_points}, duplicate points: {duplicate_points}, loaded points: {count}")
+        if sidecar_writer:
+            sidecar_points.tofile(sidecar_writer)
+            finish_sidecar(sidecar_writer, filename, sha256, valid_points, bad_points)
+    except Exception:
+        if sidecar_writer:
+            discard_sidecar(sidecar_writer, filename)
+        raise
+
+    logging.info(f"bad points: {bad_points}, duplicate points: {duplicate_points}, loaded points: {count}")
+
+    if ledger:
+        with ledger:
+            save_summary(ledger, filename, summary, count, bad_points, duplicate_points, complete=True)
+            if partitions:
+                save_partition_index(ledger, accession_id, partitions)
+            clear_checkpoint(ledger, filename)
+            # in the same transaction as the checkpoint is cleared, so a finished load is never taken for a new file
+            if entry:
+                entry['row_count'] = count
+                record_load(ledger, entry)
 
     return count
 
 
-def point_within_tolerance(previous, current):
+def new_summary(grid_resolution=None):
+    summary = {'min_lon': None, 'min_lat': None, 'max_lon': None, 'max_lat': None,
+               'grid_resolution': grid_resolution, 'grid': None}
+    if grid_resolution:
+        rows, columns = grid_shape(grid_resolution)
+        summary['grid'] = bytearray((rows * columns + 7) // 8)
+    return summary
+
+
+def grid_shape(grid_resolution):
+    return math.ceil(180 / grid_resolution), math.ceil(360 / grid_resolution)
+
+
+def add_to_summary(summary, coords):
+    lon, lat = coords[0], coords[1]
+    if summary['min_lon'] is None:
+        summary['min_lon'] = summary['max_lon'] = lon
+        summary['min_lat'] = summary['max_lat'] = lat
+    else:
+        if lon < summary['min_lon']:
+            summary['min_lon'] = lon
+        elif lon > summary['max_lon']:
+            summary['max_lon'] = lon
+        if lat < summary['min_lat']:
+            summary['min_lat'] = lat
+        elif lat > summary['max_lat']:
+            summary['max_lat'] = lat
+
+    if summary['grid'] is not None:
+        rows, columns = grid_shape(summary['grid_resolution'])
+        # points on the east or north edge fall in the last column or row
+        row = min(int((lat + 90) / summary['grid_resolution']), rows - 1)
+        column = min(int((lon + 180) / summary['grid_resolution']), columns - 1)
+        cell = row * columns + column
+        summary['grid'][cell // 8] |= 1 << (cell % 8)
+
+
+def new_partitions(partition_dir, zoom):
+    """
+    return the state of a file's partitioned export: points waiting to be written and the point count and extent of
+    each tile, keyed by (x, y)
+    """
+    return {'dir': partition_dir, 'zoom': zoom, 'buffers': {}, 'index': {}}
+
+
+def get_tile(lon, lat, zoom):
+    """return the (x, y) of the web mercator tile containing the point"""
+    tiles = 2 ** zoom
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    x = int((lon + 180) / 360 * tiles)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * tiles)
+    return min(x, tiles - 1), min(max(y, 0), tiles - 1)
+
+
+def add_to_partitions(partitions, coords):
+    lon, lat = coords[0], coords[1]
+    tile = get_tile(lon, lat, partitions['zoom'])
+    buffer = partitions['buffers'].get(tile)
+    if buffer is None:
+        buffer = partitions['buffers'][tile] = array('d')
+    buffer.append(lon)
+    buffer.append(lat)
+
+    extent = partitions['index'].get(tile)
+    if extent is None:
+        partitions['index'][tile] = [1, lon, lat, lon, lat]
+    else:
+        extent[0] += 1
+        extent[1] = min(extent[1], lon)
+        extent[2] = min(extent[2], lat)
+        extent[3] = max(extent[3], lon)
+        extent[4] = max(extent[4], lat)
+
+
+def partition_filename(partition_dir, zoom, x, y, accession_id):
+    return f"{partition_dir}/{zoom}/{x}/{y}/{accession_id}.pts"
+
+
+def flush_partitions(partitions, accession_id):
+    """append the buffered points to each tile's partition file"""
+    for (x, y), buffer in partitions['buffers'].items():
+        filename = partition_filename(partitions['dir'], partitions['zoom'], x, y, accession_id)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'ab') as writer:
+            buffer.tofile(writer)
+    partitions['buffers'] = {}
+
+
+def save_partition_index(ledger, accession_id, partitions):
+    ledger.executemany("INSERT OR REPLACE INTO partition_index VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(accession_id, partitions['zoom'], x, y, *extent)
+                        for (x, y), extent in partitions['index'].items()])
+
+
+def restore_partitions(ledger, accession_id, partitions):
+    """
+    carry on the partitioned export of an interrupted load. Partition files are cut back to the point counts saved
+    with the last checkpoint, dropping anything written after it, and files of tiles first written after it are removed
+    """
+    indexed_files = set()
+    for tile, partition_file in list_partitions(ledger, accession_id, partitions['dir']):
+        x, y, point_count, min_lon, min_lat, max_lon, max_lat = tile
+        if partitions['zoom'] != int(partition_file.split('/')[-4]):
+            raise Exception(f"accession {accession_id} was partitioned at another zoom level")
+        partitions['index'][(x, y)] = [point_count, min_lon, min_lat, max_lon, max_lat]
+        with open(partition_file, 'ab') as writer:
+            writer.truncate(point_count * 16)
+        indexed_files.add(partition_file)
+
+    for partition_file in find_partition_files(partitions['dir'], partitions['zoom'], accession_id):
+        if partition_file not in indexed_files:
+            os.remove(partition_file)
+
+
+def clear_partitions(ledger, accession_id, partitions=None):
+    """
+    remove the index rows of an accession before it is exported from scratch or reloaded, and its partition files when
+    the partition directory is known
+    """
+    if ledger is None:
+        return
+
+    if partitions:
+        # including files written after the last checkpoint of an interrupted load, which aren't in the index
+        partition_files = {partition_file
+                           for _, partition_file in list_partitions(ledger, accession_id, partitions['dir'])}
+        partition_files.update(find_partition_files(partitions['dir'], partitions['zoom'], accession_id))
+        for partition_file in partition_files:
+            try:
+                os.remove(partition_file)
+            except FileNotFoundError:
+                pass
+    with ledger:
+        ledger.execute("DELETE FROM partition_index WHERE accession_id = ?", (accession_id,))
+
+
+def list_partitions(ledger, accession_id, partition_dir):
+    rows = ledger.execute("SELECT zoom, x, y, point_count, min_lon, min_lat, max_lon, max_lat FROM partition_index "
+                          "WHERE accession_id = ?", (accession_id,)).fetchall()
+    return [(row[1:], partition_filename(partition_dir, row[0], row[1], row[2], accession_id)) for row in rows]
+
+
+def find_partition_files(partition_dir, zoom, accession_id):
+    """return the accession's partition files at the zoom level, whether or not they're in the index"""
+    return glob.glob(partition_filename(glob.escape(partition_dir), zoom, '*', '*', accession_id))
+
+
+def get_partitions(ledger, partition_dir, min_lon, min_lat, max_lon, max_lat, zoom=6):
+    """
+    return the partition files holding points within the bounding box. Only the index is read, so a viewport query
+    opens just the files for the tiles it covers, and only those whose points actually fall within the box
+    """
+    min_x, max_y = get_tile(min_lon, min_lat, zoom)
+    max_x, min_y = get_tile(max_lon, max_lat, zoom)
+    rows = ledger.execute(
+        "SELECT accession_id, x, y FROM partition_index WHERE zoom = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ? "
+        "AND max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?",
+        (zoom, min_x, max_x, min_y, max_y, min_lon, max_lon, min_lat, max_lat)
+    )
+    return [partition_filename(partition_dir, zoom, x, y, accession_id) for accession_id, x, y in rows]
+
+
+def get_occupied_cells(grid, grid_resolution):
+    """yield the (longitude, latitude) of the south-west corner of each occupied cell in an accession's grid"""
+    rows, columns = grid_shape(grid_resolution)
+    for cell in range(rows * columns):
+        if grid[cell // 8] & (1 << (cell % 8)):
+            yield -180 + (cell % columns) * grid_resolution, -90 + (cell // columns) * grid_resolution
+
+
+def parse_file(filename, offset=0, line_number=0):
+    """
+    yield a (byte offset following the line, line number, coordinates) tuple for each line of a text file, starting at
+    offset. Coordinates are None for a bad point
+    """
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(filename)[1])
+    with (opener or open)(filename, 'rb') as reader:
+        # a decompressed stream can't be memory-mapped. offsets are into the decompressed content
+        lines = read_large_file(reader, offset) if opener else read_lines(reader, offset)
+        for cnt, (offset, line) in enumerate(lines, start=line_number + 1):
+            try:
+                coords = get_coordinates(cnt, line)
+            except Exception as error:
+                logging.error(error)
+                coords = None
+            yield offset, cnt, coords
+
+
+def read_sidecar_header(filename, sha256):
+    """return (point count, bad point count) from the file's sidecar, if there is one written from this content"""
+    try:
+        with open(filename + SIDECAR_SUFFIX, 'rb') as reader:
+            header = reader.read(SIDECAR_HEADER.size)
+    except FileNotFoundError:
+        return None
+
+    if len(header) != SIDECAR_HEADER.size:
+        return None
+    magic, point_count, bad_points, digest = SIDECAR_HEADER.unpack(header)
+    if magic != SIDECAR_MAGIC or digest.hex() != sha256:
+        return None
+    return point_count, bad_points
+
+
+def read_sidecar(filename, point_count, start=0):
+    """
+    yield a (None, point number, coordinates) tuple for each valid point stored in the file's sidecar, after the first
+    start points
+    """
+    with open(filename + SIDECAR_SUFFIX, 'rb') as reader, \
+            mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        # interleaved longitude, latitude pairs
+        coordinates = view[SIDECAR_HEADER.size:SIDECAR_HEADER.size + point_count * 16].cast('d')
+        try:
+            for i in range(start, point_count):
+                yield None, i + 1, [coordinates[2 * i], coordinates[2 * i + 1]]
+        finally:
+            coordinates.release()
+            view.release()
+
+
+def rebuild_sidecar_prefix(writer, filename, offset):
+    """
+    write the valid points of the text file's lines before offset to a new sidecar, returning the number written, or
+    None if offset isn't the end of a line
+    """
+    points = array('d')
+    valid_points = 0
+    # bad lines were logged by the interrupted load
+    logging.disable(logging.ERROR)
+    try:
+        for line_end, _, coords in parse_file(filename):
+            if line_end > offset:
+                return None
+            if coords is not None:
+                valid_points += 1
+                points.extend(coords)
+                if len(points) >= 2 * BATCH_SIZE:
+                    points.tofile(writer)
+                    del points[:]
+            if line_end == offset:
+                points.tofile(writer)
+                return valid_points
+    finally:
+        logging.disable(logging.NOTSET)
+    return None
+
+
+def create_sidecar(filename):
+    writer = open(filename + SIDECAR_SUFFIX + '.part', 'wb')
+    # header is filled in once the point count is known
+    writer.write(bytes(SIDECAR_HEADER.size))
+    return writer
+
+
+def finish_sidecar(writer, filename, sha256, point_count, bad_points):
+    writer.seek(0)
+    writer.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, point_count, bad_points, bytes.fromhex(sha256)))
+    writer.close()
+    os.replace(filename + SIDECAR_SUFFIX + '.part', filename + SIDECAR_SUFFIX)
+
+
+def discard_sidecar(writer, filename):
+    writer.close()
+    os.remove(filename + SIDECAR_SUFFIX + '.part')
+
+
+def point_within_tolerance(previous, current, tolerance=TOLERANCE):
     # first row doesn't have a previous
     if previous is None:
         return False
 
-    tolerance = 0.0001  # ~11m at equator
     # skip subsequent point if both longitude and latitude values w/in tolerance. assumes both pairs in same accession
     if abs(previous[0] - current[0]) < tolerance and abs(previous[1] - current[1]) < tolerance:
         return True
@@ -105,10 +689,79 @@ def point_within_tolerance(previous, current):
         return False
 
 
-# TODO
+def write_batch(batch):
+    """insert the batch, first waiting for a free DB writer slot when running in a process pool"""
+    with_writer_slot(insert_rows, batch)
+
+
+def with_writer_slot(func, *args):
+    if writer_slots is None:
+        return func(*args)
+
+    # a worker only holds a connection while it holds a slot, so there are no more sessions than writers
+    with writer_slots:
+        try:
+            return func(*args)
+        finally:
+            close_db_connection()
+
+
+def get_db_connection():
+    """this process's connection to the database holding the points table, opened on first use"""
+    global db_connection
+    if db_connection is None:
+        if db_connect_string is None:
+            raise Exception("no database connection details given")
+        # imported here so oads_benchmark.py, which stands SQLite in for the points table, needs no Oracle client
+        import cx_Oracle
+        db_connection = cx_Oracle.connect(db_connect_string)
+    return db_connection
+
+
+def close_db_connection():
+    """roll back anything uncommitted, e.g. after a database error, and close the connection. The next use reopens it"""
+    global db_connection
+    if db_connection is None:
+        return
+    try:
+        db_connection.rollback()
+        db_connection.close()
+    except Exception:
+        # the session may already be gone
+        pass
+    db_connection = None
+
+
 def insert_rows(batch):
-    # print(batch)
-    pass
+    """insert and commit a batch of [lon, lat, accession id, line number] rows"""
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.executemany(f"INSERT INTO {POINTS_TABLE} (LON, LAT, ACCESSION_ID, LINE_NUMBER) "
+                               f"VALUES (:1, :2, :3, :4)", batch)
+        connection.commit()
+    except Exception:
+        close_db_connection()
+        raise
+
+
+def delete_rows(accession_id, after_line=None):
+    """
+    delete and commit every point of the accession, e.g. before its file is reloaded, or only those past after_line when
+    an interrupted load resumes
+    """
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            if after_line is None:
+                cursor.execute(f"DELETE FROM {POINTS_TABLE} WHERE ACCESSION_ID = :1", [accession_id])
+            else:
+                cursor.execute(f"DELETE FROM {POINTS_TABLE} WHERE ACCESSION_ID = :1 AND LINE_NUMBER > :2",
+                               [accession_id, after_line])
+        connection.commit()
+    except Exception:
+        close_db_connection()
+        raise
 
 
 def get_coordinates(line_number, line):
@@ -117,7 +770,7 @@ def get_coordinates(line_number, line):
         # 4 decimal places precision allows ~11m at equator
         lon = round(float(elements[0].strip()), 3)
         lat = round(float(elements[1].strip()), 3)
-    except ValueError:
+    except (ValueError, IndexError):
         raise Exception(f"line number {line_number}: Longitude or Latitude value is not a number")
     if lon < -180.0 or lon > 180.0:
         raise Exception(f"line_number {line_number}: Bad longitude: {lon}")
@@ -128,28 +781,159 @@ def get_coordinates(line_number, line):
     return [lon, lat]
 
 
-def get_new_files(current_accessions):
-    """return a list of filenames which don't have a corresponding accession ID in the given list"""
-    new_files = []
-    for filename in glob.glob(DATA_DIR + "*.txt"):
-        accession_id = get_accession_id_from_filename(filename)
-        if accession_id not in current_accessions:
-            new_files.append(filename)
+def get_new_files(ledger, reprocess=False):
+    """
+    return a list of entries for files which are not in the ledger or whose content changed since they were loaded.
+    Files with the same size and mtime as recorded in the ledger are skipped without being opened, unless reprocessing
+    """
+    on_disk = {}
+    with os.scandir(DATA_DIR) as it:
+        for dir_entry in it:
+            if dir_entry.name.endswith(DATA_SUFFIXES) and dir_entry.is_file():
+                stat = dir_entry.stat()
+                on_disk[dir_entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+    loaded = get_loaded_files(ledger)
+    loaded_accessions = get_loaded_accessions(ledger)
+
+    new_names = on_disk.keys() - loaded.keys()
+    modified_names = {name for name in on_disk.keys() & loaded.keys() if on_disk[name] != loaded[name][:2]}
+
+    # a new name for an accession already loaded, e.g. once the file is compressed, replaces its points
+    new_files = [file_entry(name, *on_disk[name], reload=get_accession_id_from_filename(name) in loaded_accessions)
+                 for name in sorted(new_names)]
+    for name in sorted(modified_names):
+        size, mtime_ns = on_disk[name]
+        checksum = file_checksum(DATA_DIR + name)
+        if checksum == loaded[name][2]:
+            # touched but not re-published. record the new mtime so the file isn't hashed again next run
+            ledger.execute("UPDATE load_ledger SET size = ?, mtime_ns = ? WHERE filename = ?", (size, mtime_ns, name))
+            continue
+        new_files.append(file_entry(name, size, mtime_ns, checksum, reload=True))
+    ledger.commit()
+
+    if reprocess:
+        unchanged_names = (on_disk.keys() & loaded.keys()) - modified_names
+        for name in sorted(unchanged_names):
+            new_files.append(file_entry(name, *on_disk[name], loaded[name][2], reload=True))
 
     return new_files
 
 
+def file_entry(name, size, mtime_ns, sha256=None, reload=False):
+    return {
+        'filename': DATA_DIR + name,
+        'name': name,
+        'accession_id': get_accession_id_from_filename(name),
+        'size': size,
+        'mtime_ns': mtime_ns,
+        'sha256': sha256,
+        'reload': reload,
+        'row_count': None
+    }
+
+
+def file_checksum(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def open_ledger(path):
+    """open the SQLite ledger of loaded files, creating it if necessary"""
+    ledger = sqlite3.connect(path, timeout=60)
+    ledger.execute(LEDGER_SCHEMA)
+    ledger.execute(CHECKPOINT_SCHEMA)
+    ledger.execute(SUMMARY_SCHEMA)
+    ledger.execute(PARTITION_SCHEMA)
+    return ledger
+
+
+def get_checkpoint(ledger, filename, sha256):
+    """
+    return (byte offset, line number, previous coordinates, loaded, bad and duplicate point counts) from the last
+    batch committed for the file, or None if there is no checkpoint for this version of the file. The byte offset is
+    None, and the line number a sidecar point number, when the points were read from the file's sidecar
+    """
+    row = ledger.execute(
+        "SELECT sha256, byte_offset, line_number, prev_lon, prev_lat, loaded_points, bad_points, duplicate_points "
+        "FROM load_checkpoint WHERE filename = ?", (filename.split('/')[-1],)
+    ).fetchone()
+    if row is None or row[0] != sha256:
+        return None
+
+    prev_coords = [row[3], row[4]] if row[3] is not None else None
+    return row[1], row[2], prev_coords, row[5], row[6], row[7]
+
+
+def save_checkpoint(ledger, filename, sha256, offset, line_number, prev_coords, count, bad_points, duplicate_points):
+    prev_lon, prev_lat = prev_coords[:2] if prev_coords else (None, None)
+    ledger.execute("INSERT OR REPLACE INTO load_checkpoint VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (filename.split('/')[-1], sha256, offset, line_number, prev_lon, prev_lat, count, bad_points,
+                    duplicate_points))
+
+
+def clear_checkpoint(ledger, filename):
+    ledger.execute("DELETE FROM load_checkpoint WHERE filename = ?", (filename.split('/')[-1],))
+
+
+def get_partial_summary(ledger, filename, grid_resolution=None):
+    """return the summary saved with the file's last checkpoint, or None if there isn't one"""
+    row = ledger.execute(
+        "SELECT min_lon, min_lat, max_lon, max_lat, grid_resolution, grid FROM accession_summary "
+        "WHERE accession_id = ? AND filename = ? AND complete = 0",
+        (get_accession_id_from_filename(filename), filename.split('/')[-1])
+    ).fetchone()
+    if row is None:
+        return None
+
+    summary = new_summary(grid_resolution)
+    summary['min_lon'], summary['min_lat'], summary['max_lon'], summary['max_lat'] = row[:4]
+    # a grid of another resolution can't be carried on with
+    if grid_resolution and row[4] == grid_resolution:
+        summary['grid'] = bytearray(row[5])
+    return summary
+
+
+def save_summary(ledger, filename, summary, count, bad_points, duplicate_points, complete):
+    grid = bytes(summary['grid']) if summary['grid'] is not None else None
+    ledger.execute("INSERT OR REPLACE INTO accession_summary VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (get_accession_id_from_filename(filename), filename.split('/')[-1], summary['min_lon'],
+                    summary['min_lat'], summary['max_lon'], summary['max_lat'], count, duplicate_points, bad_points,
+                    summary['grid_resolution'], grid, int(complete)))
+
+
+def get_loaded_files(ledger):
+    """return a dictionary of filename: (size, mtime_ns, sha256) for each file recorded in the ledger"""
+    rows = ledger.execute("SELECT filename, size, mtime_ns, sha256 FROM load_ledger")
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def invalidate_load(ledger, accession_id):
+    """mark the accession's recorded loads as out of date, so they're loaded again unless the reload finishes"""
+    ledger.execute("UPDATE load_ledger SET size = -1, sha256 = '' WHERE accession_id = ?", (accession_id,))
+
+
+def get_loaded_accessions(ledger):
+    return {row[0] for row in ledger.execute("SELECT DISTINCT accession_id FROM load_ledger")}
+
+
+def record_load(ledger, entry):
+    ledger.execute(
+        "INSERT OR REPLACE INTO load_ledger (filename, accession_id, size, mtime_ns, sha256, row_count) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (entry['name'], entry['accession_id'], entry['size'], entry['mtime_ns'], entry['sha256'], entry['row_count'])
+    )
+
+
 # depends on file name convention like "NNNNNNN_lonlat.txt" where "NNNNNNN" represents accession ID.
 def get_accession_id_from_filename(filename):
     name = filename.split('/')[-1]
     return name.split('_')[0]
 
 
-# TODO
-def get_accession_ids():
-    return ['0000183', '0000071']
-
-
 if __name__ == "__main__":
     # global vars
     logging.basicConfig(level=logging.INFO)
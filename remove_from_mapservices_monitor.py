@@ -3,7 +3,11 @@ import os
 import codecs
 import json
 import logging
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
 import socket
 import urllib3
 
@@ -12,11 +16,35 @@ localhost = socket.gethostname()
 # ignore warning about NGDC-signed certificate
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+CHECKS_URL = "https://gisdev.ngdc.noaa.gov/mapservices-monitor/healthChecks"
 
-def get_running_services(services=[], folder=None, type='MapServer'):
+SERVICE_TYPES = ('MapServer', 'ImageServer')
+
+# request made by the health check of each type of service
+CHECK_OPERATIONS = {
+    'MapServer': "export?dpi=96&transparent=true&format=png8&bbox=-170,-85,170,85&bboxSR=4269&size=500,250&f=image",
+    'ImageServer': "exportImage?format=png&bbox=-170,-85,170,85&bboxSR=4269&size=500,250&f=image"
+}
+
+
+def create_session(max_connections=8):
+    """session shared by every request, keeping up to max_connections open to each host"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max_connections, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not localhost.startswith('lynx'):
+        # SOCKS proxy needed
+        session.proxies = dict(https='socks5://localhost:5001')
+        session.verify = False
+    return session
+
+
+def get_running_services(services=[], folder=None, type='MapServer', session=None):
     """ returns a list of all the map service names (including folder) on the target host """
 
     logging.debug(f"inside get_running_services with {target_host}")
+    session = session or create_session()
     base_url = f"https://{target_host}/arcgis/rest/services"
     params = {'f': 'json'}
     headers = {"Accept": "application/json"}
@@ -24,122 +52,169 @@ def get_running_services(services=[], folder=None, type='MapServer'):
         url = base_url+'/'+folder
     else:
         url = base_url
-    # r = requests.get(url, headers=headers, params=params)
-    if localhost.startswith('lynx'):
-        # SOCKS proxy not needed
-        r = requests.get(url, params=params, headers=headers)
-    else:
-        r = requests.get(url, params=params, headers=headers, proxies=dict(https='socks5://localhost:5001'),
-                         verify=False)
+    r = session.get(url, params=params, headers=headers)
     data = r.json()
 
     mapservices = [i['name'] for i in data['services'] if i['type'] == type]
     services.extend(mapservices)
 
     for foldername in data['folders']:
-        get_running_services(services, foldername, type)
+        get_running_services(services, foldername, type, session)
 
 
-def get_existing_checks():
-    """ returns a list of the URLs used by currently defined checks"""
+def get_existing_checks(session=None):
+    """ returns a list of the currently defined checks"""
 
-    url = f"https://gisdev.ngdc.noaa.gov/mapservices-monitor/healthChecks"
+    session = session or create_session()
     headers = {"Accept": "application/json"}
-    params = {}
-    if localhost.startswith('lynx'):
-        # SOCKS proxy not needed
-        r = requests.get(url, params=params, headers=headers)
-    else:
-        r = requests.get(url, params=params, headers=headers, proxies=dict(https='socks5://localhost:5001'),
-                         verify=False)
+    r = session.get(CHECKS_URL, headers=headers)
 
-    if r.status_code is not 200:
+    if r.status_code != 200:
         raise Exception("unable to query API")
 
-    response = r.json()
+    return r.json()
 
-    if len(response) == 0:
-        return False
 
-    return [i['url'] for i in response]
-
-
-def check_existing_record(servicename=None, service_type='MapServer'):
-    """ returns True if any previously defined health check has a URL referencing the provided service name"""
-
-    if not servicename:
-        raise Exception("a servicename must be provided")
-
-    # url = f"https://gisdev.ngdc.noaa.gov/mapservices-monitor/healthChecks"
-    # headers = {"Accept": "application/json"}
-    # params = {}
-    # if localhost.startswith('lynx'):
-    #     # SOCKS proxy not needed
-    #     r = requests.get(url, params=params, headers=headers)
-    # else:
-    #     r = requests.get(url, params=params, headers=headers, proxies=dict(https='socks5://localhost:5001'),
-    #                      verify=False)
-    #
-    # if r.status_code is not 200:
-    #     raise Exception("unable to query API")
-    #
-    # response = r.json()
-    #
-    # if len(response) == 0:
-    #     return False
-    #
-    # service_urls = [i['url'] for i in response]
-
-    for i in existing_check_urls:
-        # if i.startswith(f"https://{target_host}/arcgis/rest/services/{servicename}/{service_type}"):
-        if i.startswith(f"http://wildcat.ngdc.noaa.gov:6080/arcgis/rest/services/{servicename}/{service_type}"):
-            return True
-
-    return False
-
-
-def insert_record(servicename=None, service_type='MapServer', tags=None):
-    logging.info(f"inserting record for {servicename}")
-    url = "https://gisdev.ngdc.noaa.gov/mapservices-monitor/healthChecks"
+def check_key(url):
+    """
+    returns the (host, service name including folder, service type) a health check URL refers to, or None when it
+    isn't a map or image service URL
+    """
+    parts = urlsplit(url)
+    path = parts.path.split('/arcgis/rest/services/', 1)
+    if len(path) != 2:
+        return None
+
+    segments = path[1].split('/')
+    for i, segment in enumerate(segments):
+        if segment in SERVICE_TYPES and i > 0:
+            return parts.netloc.lower(), '/'.join(segments[:i]), segment
+    return None
+
+
+def index_checks(checks):
+    """ returns {(host, service name, service type): [checks]} """
+    index = {}
+    for check in checks:
+        key = check_key(check['url'])
+        if key:
+            index.setdefault(key, []).append(check)
+    return index
+
+
+def check_url(servicename, service_type='MapServer'):
+    return f"{check_base_url}/{servicename}/{service_type}/{CHECK_OPERATIONS[service_type]}"
+
+
+def get_changes(running_services, index, prune=False):
+    """
+    returns the (service name, service type) of the running services without a health check, and, when pruning, the
+    checks to delete: those of services no longer running on the host and any extra checks of a service
+    """
+    host = urlsplit(check_base_url).netloc.lower()
+    wanted = {(host, servicename, service_type) for servicename, service_type in running_services}
+    existing = {key for key in index if key[0] == host}
+
+    adds = sorted((servicename, service_type) for _, servicename, service_type in wanted - existing)
+
+    deletes = []
+    if prune:
+        for key in existing:
+            # a running service only needs a single check
+            deletes.extend(index[key] if key not in wanted else index[key][1:])
+    return adds, deletes
+
+
+def insert_record(servicename=None, service_type='MapServer', tags=None, session=None):
+    logging.info(f"inserting record for {servicename}/{service_type}")
+    session = session or create_session()
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
     # define the health check parameters
-    #         "url": f"https://{target_host}/arcgis/rest/services/{servicename}/{service_type}/export?dpi=96&transparent=true&format=png8&bbox=-84,34,-81,37&bboxSR=4269&size=250,250&f=image",
     data = json.dumps({
-        "url": f"http://wildcat.ngdc.noaa.gov:6080/arcgis/rest/services/{servicename}/{service_type}/export?dpi=96&transparent=true&format=png8&bbox=-170,-85,170,85&bboxSR=4269&size=500,250&f=image",
+        "url": check_url(servicename, service_type),
         "checkInterval": "HOURLY",
         "tags": tags
     })
 
-    if localhost.startswith('lynx'):
-        # SOCKS proxy not needed
-        r = requests.post(url, data=data, headers=headers, auth=(api_user, api_password))
-    else:
-        r = requests.post(url, data=data, headers=headers, auth=(api_user, api_password),
-                          proxies=dict(https='socks5://localhost:5001'), verify=False)
+    r = session.post(CHECKS_URL, data=data, headers=headers, auth=(api_user, api_password))
     if r.status_code == 201:
         return True
     else:
         return False
 
+
+def delete_record(check, session=None):
+    logging.info(f"deleting record for {check['url']}")
+    session = session or create_session()
+    headers = {"Accept": "application/json"}
+
+    r = session.delete(f"{CHECKS_URL}/{check['id']}", headers=headers, auth=(api_user, api_password))
+    return r.status_code in (200, 204)
+
+
+def apply_changes(adds, deletes, session, workers=8):
+    """
+    POST the new checks and DELETE the stale ones concurrently. The monitor has no bulk endpoint, so each is its own
+    request over the shared session. Returns the number of failed requests
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(insert_record, servicename, service_type, service_tags, session)
+                   for servicename, service_type in adds]
+        futures += [executor.submit(delete_record, check, session) for check in deletes]
+
+    failures = 0
+    for future in futures:
+        try:
+            if not future.result():
+                failures += 1
+        except Exception as e:
+            logging.error(e)
+            failures += 1
+    return failures
+
+
 def main():
     """
     read each map and image service from specified ArcGIS Server and add entry into mapservice-monitor if none already
     exists
     """
-
-    mapservices = []
-    get_running_services(services=mapservices)
-
-    imageservices = []
-    get_running_services(services=imageservices, type='ImageServer')
-
-    for servicename in mapservices:
-        if not check_existing_record(servicename=servicename):
-            insert_record(servicename=servicename, tags=service_tags)
-            pass
-        else:
-            logging.debug(f"found existing record for {servicename}")
+    arg_parser = argparse.ArgumentParser(
+        description="""add a mapservices-monitor health check for each map and image service on the server"""
+    )
+    arg_parser.add_argument("--dry_run", help="report the checks to add and delete but no changes made",
+                            action="store_true")
+    arg_parser.add_argument("--prune", action="store_true",
+                            help="also delete the checks of services no longer running on the server, and duplicate "
+                                 "checks")
+    arg_parser.add_argument("--workers", type=int, default=8, help="number of concurrent requests to the monitor")
+    args = arg_parser.parse_args()
+
+    session = create_session(args.workers)
+
+    # one pass over the existing checks, indexed for constant time lookups
+    index = index_checks(get_existing_checks(session))
+
+    running_services = []
+    for service_type in SERVICE_TYPES:
+        services = []
+        get_running_services(services=services, type=service_type, session=session)
+        running_services.extend((servicename, service_type) for servicename in services)
+
+    adds, deletes = get_changes(running_services, index, args.prune)
+    logging.info(f"{len(running_services)} services running, {len(adds)} checks to add, {len(deletes)} to delete")
+
+    if args.dry_run:
+        for servicename, service_type in adds:
+            logging.info(f"dry_run: would insert record for {servicename}/{service_type}")
+        for check in deletes:
+            logging.info(f"dry_run: would delete record for {check['url']}")
+        return
+
+    failures = apply_changes(adds, deletes, session, args.workers)
+    if failures:
+        logging.error(f"{failures} changes failed")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -147,10 +222,9 @@ if __name__ == "__main__":
 
     # globals
     target_host = 'wildcat.ngdc.noaa.gov:6443'
+    check_base_url = 'http://wildcat.ngdc.noaa.gov:6080/arcgis/rest/services'
     api_user = 'admin'
     api_password = 'mypassword'
     service_tags = ["dynamic", "arcgis", "boulder", "wildcat"]
 
-    existing_check_urls = get_existing_checks()
-
     main()
@@ -0,0 +1,171 @@
+import argparse
+import itertools
+import json
+import logging
+import math
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import urllib3
+from server_comparison_report import get_service_names
+
+# ignore warning about NGDC-signed certificate
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# operation rendering an image for each type of service
+EXPORT_OPERATIONS = {'MapServer': 'export', 'ImageServer': 'exportImage'}
+
+PERCENTILES = (50, 95, 99)
+
+
+def main(args):
+    session = create_session(args.concurrency)
+
+    # one request for each server, service, render settings and repetition
+    render_sets = [{'bbox': bbox, 'size': size, 'dpi': dpi}
+                   for bbox, size, dpi in itertools.product(args.bbox or ['-170,-85,170,85'], args.size or ['500,250'],
+                                                            args.dpi or ['96'])]
+    requests_to_send = []
+    for server in args.server:
+        uri = f"{server}:{args.port}"
+        service_list = []
+        get_service_names(uri, service_list, None, args.service_type)
+        if args.services:
+            service_list = [service for service in service_list if service in args.services]
+        logging.info(f"{len(service_list)} services on {server}")
+        for service in service_list:
+            for render_set in render_sets:
+                url = export_url(uri, service, args.service_type)
+                params = export_params(render_set, args.bbox_sr, args.format, args.service_type)
+                requests_to_send.extend([(server, service, url, params)] * args.requests)
+
+    # interleave the services, so each is measured under the same load rather than one at a time
+    random.shuffle(requests_to_send)
+    logging.info(f"sending {len(requests_to_send)} export requests, {args.concurrency} at a time")
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda request: timed_export(session, *request, timeout=args.timeout),
+                                    requests_to_send))
+
+    service_stats = summarize(results, lambda result: (result['server'], result['service']))
+    server_stats = summarize(results, lambda result: result['server'])
+
+    # slowest services first
+    print("server\tservice\trequests\terrors\tp50\tp95\tp99")
+    for (server, service), stats in sorted(service_stats.items(), key=lambda item: item[1]['p95'] or math.inf,
+                                           reverse=True):
+        print(f"{server}\t{service}\t{stats['requests']}\t{stats['errors']}\t{format_seconds(stats['p50'])}\t"
+              f"{format_seconds(stats['p95'])}\t{format_seconds(stats['p99'])}")
+
+    print()
+    print("server\trequests\terrors\tp50\tp95\tp99")
+    for server, stats in server_stats.items():
+        print(f"{server}\t{stats['requests']}\t{stats['errors']}\t{format_seconds(stats['p50'])}\t"
+              f"{format_seconds(stats['p95'])}\t{format_seconds(stats['p99'])}")
+
+    if args.output:
+        with open(args.output, 'w') as writer:
+            json.dump({'servers': server_stats,
+                       'services': [dict(stats, server=server, service=service)
+                                    for (server, service), stats in service_stats.items()]}, writer, indent=2)
+
+
+def create_session(max_connections=8):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max_connections, pool_block=True)
+    session.mount('https://', adapter)
+    session.verify = False
+    return session
+
+
+def export_url(hostname, service, service_type='MapServer'):
+    return f"https://{hostname}/arcgis/rest/services/{service}/{service_type}/{EXPORT_OPERATIONS[service_type]}"
+
+
+def export_params(render_set, bbox_sr='4269', image_format='png8', service_type='MapServer'):
+    params = {'bbox': render_set['bbox'], 'bboxSR': bbox_sr, 'size': render_set['size'], 'format': image_format,
+              'f': 'image'}
+    # image services render at their own resolution
+    if service_type == 'MapServer':
+        params.update({'dpi': render_set['dpi'], 'transparent': 'true'})
+    return params
+
+
+def timed_export(session, server, service, url, params, timeout=60):
+    """request one image, returning the seconds taken and any error"""
+    start = time.perf_counter()
+    error = None
+    try:
+        r = session.get(url, params=params, timeout=timeout)
+        # errors come back as JSON with a 200 status
+        if r.status_code != 200:
+            error = f"HTTP {r.status_code}"
+        elif not r.headers.get('Content-Type', '').startswith('image/'):
+            error = r.text[:200]
+    except requests.exceptions.RequestException as e:
+        error = str(e)
+    seconds = time.perf_counter() - start
+
+    if error:
+        logging.debug(f"{server} {service}: {error}")
+    return {'server': server, 'service': service, 'seconds': seconds, 'error': error}
+
+
+def summarize(results, key):
+    """request and error counts and latency percentiles of the successful requests, for each key"""
+    groups = {}
+    for result in results:
+        groups.setdefault(key(result), []).append(result)
+
+    stats = {}
+    for group, group_results in groups.items():
+        latencies = sorted(result['seconds'] for result in group_results if not result['error'])
+        stats[group] = {'requests': len(group_results), 'errors': len(group_results) - len(latencies)}
+        for p in PERCENTILES:
+            stats[group][f"p{p}"] = percentile(latencies, p)
+    return stats
+
+
+def percentile(sorted_values, p):
+    """nearest-rank percentile, or None without any values"""
+    if not sorted_values:
+        return None
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def format_seconds(seconds):
+    return '-' if seconds is None else f"{seconds:.3f}"
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # setup command line arguments
+    arg_parser = argparse.ArgumentParser(
+        description="""measure export latency of the map/image services on the specified server(s) under load"""
+    )
+    arg_parser.add_argument('--server', action='append', required=True,
+                            help="fully-qualified target server name. specify once for each server")
+    arg_parser.add_argument("--port", default="6443", help="server port")
+    arg_parser.add_argument('--service_type', default='MapServer', choices=['MapServer', 'ImageServer'],
+                            help="test MapServer or ImageServer instances")
+    arg_parser.add_argument('--services', nargs='+', help="names of the services to test. defaults to every service")
+    arg_parser.add_argument('--bbox', action='append',
+                            help="xmin,ymin,xmax,ymax of an export. specify once for each extent. "
+                                 "defaults to -170,-85,170,85")
+    arg_parser.add_argument('--bbox_sr', default='4269', help="spatial reference of the bbox values")
+    arg_parser.add_argument('--size', action='append',
+                            help="width,height of an export in pixels. specify once for each size. defaults to 500,250")
+    arg_parser.add_argument('--dpi', action='append', help="dpi of a map export. specify once for each. defaults to 96")
+    arg_parser.add_argument('--format', default='png8', help="image format")
+    arg_parser.add_argument('--requests', type=int, default=10,
+                            help="number of requests sent to each service for each bbox, size and dpi")
+    arg_parser.add_argument('--concurrency', type=int, default=8, help="number of requests in flight")
+    arg_parser.add_argument('--timeout', type=float, default=60, help="seconds before a request counts as an error")
+    arg_parser.add_argument('--output', help="also write the statistics to this JSON file")
+    args = arg_parser.parse_args()
+
+    main(args)
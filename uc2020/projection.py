@@ -0,0 +1,53 @@
+import numpy as np
+
+# project between WGS84 (EPSG:4326) and Web Mercator (EPSG:3857) locally rather than calling the geometry service.
+# spherical Mercator is closed-form, so whole arrays of points are projected at once
+
+# WGS84 semi-major axis, used as the sphere radius by Web Mercator
+EARTH_RADIUS = 6378137.0
+
+# latitude at which Web Mercator becomes square. points further north or south are clamped to it
+MAX_LATITUDE = 85.0511287798066
+
+WEB_MERCATOR = {'wkid': 102100, 'latestWkid': 3857}
+WGS84 = {'wkid': 4326, 'latestWkid': 4326}
+
+
+def geographic_to_web_mercator(lon, lat):
+    """return the x, y arrays in meters of the given longitude, latitude values or arrays in degrees"""
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE)
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def web_mercator_to_geographic(x, y):
+    """return the longitude, latitude arrays in degrees of the given x, y values or arrays in meters"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lon = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+def project_geometries(geometries, in_sr=4326, out_sr=3857):
+    """
+    project a list of point geometries, e.g. [{'x': lon, 'y': lat}], in the same form as arcgis.geometry.project
+    returns them
+    """
+    if not geometries:
+        return []
+
+    xs = [float(geom['x']) for geom in geometries]
+    ys = [float(geom['y']) for geom in geometries]
+    if (in_sr, out_sr) == (4326, 3857):
+        xs, ys = geographic_to_web_mercator(xs, ys)
+        spatial_reference = WEB_MERCATOR
+    elif (in_sr, out_sr) == (3857, 4326):
+        xs, ys = web_mercator_to_geographic(xs, ys)
+        spatial_reference = WGS84
+    else:
+        raise ValueError(f"projection from {in_sr} to {out_sr} is not supported")
+
+    return [{'x': x, 'y': y, 'spatialReference': dict(spatial_reference)} for x, y in zip(xs.tolist(), ys.tolist())]
@@ -0,0 +1,218 @@
+import argparse
+import logging
+import sys
+import time
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import yaml
+import cx_Oracle
+from arcgis.gis import GIS
+from arcgis.features import Feature
+import projection
+import update_nexrad
+
+DEFAULT_CONFIG = 'sync_featurelayers.yml'
+
+
+def main():
+    # setup command line arguments
+    arg_parser = argparse.ArgumentParser(
+        description="""update hosted FeatureLayers from Oracle database queries listed in a YAML file"""
+    )
+    arg_parser.add_argument("--config", default=DEFAULT_CONFIG,
+                            help="YAML file listing each layer's query and field map. "
+                                 "see sync_featurelayers.example.yml")
+    arg_parser.add_argument("--layers", nargs='+', help="names of the layers to sync. defaults to every layer")
+    arg_parser.add_argument("--dry_run", action="store_true",
+                            help="query database but no changes made to FeatureLayers")
+    args = arg_parser.parse_args()
+
+    if args.dry_run:
+        logging.info('dry_run mode: no changes will be made')
+
+    with open(args.config, 'r') as yaml_file:
+        cfg = yaml.safe_load(yaml_file)
+
+    layers = cfg['layers']
+    if args.layers:
+        layers = [layer_cfg for layer_cfg in layers if layer_cfg['name'] in args.layers]
+        unknown = set(args.layers) - {layer_cfg['name'] for layer_cfg in layers}
+        if unknown:
+            logging.error(f"no layers named {', '.join(sorted(unknown))} in {args.config}")
+            sys.exit(1)
+
+    # one GIS login and one connection pool are shared by every layer
+    gp_cfg = cfg['geoplatform']
+    try:
+        geoplatform = GIS(gp_cfg.get('url', "https://noaa.maps.arcgis.com"), gp_cfg['username'], gp_cfg['password'])
+    except RuntimeError:
+        raise RuntimeError(f"failed to connect to the NOAA GeoPlatform as user {gp_cfg['username']}")
+    workers = cfg.get('workers', 4)
+    pool = create_pool(cfg['database'], workers)
+
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(sync_layer, geoplatform, pool, layer_cfg, cfg, args.dry_run): layer_cfg['name']
+                       for layer_cfg in layers}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    report = future.result()
+                except Exception as e:
+                    logging.error(f"{name}: sync failed: {e}")
+                    failed.append(name)
+                    continue
+                logging.info(f"{name}: {report['rows']} rows, {report['adds']} added, {report['updates']} updated, "
+                             f"{report['deletes']} deleted. query and diff {report['diff_seconds']:.1f}s, "
+                             f"edits {report['edit_seconds']:.1f}s")
+    finally:
+        pool.close()
+
+    if failed:
+        sys.exit(1)
+
+
+def create_pool(db_cfg, workers=4):
+    """
+    connection pool shared by the layer syncs, with a connection for each concurrent sync. A sync waits for a free
+    connection when pool_size is smaller than workers
+    """
+    return cx_Oracle.SessionPool(user=db_cfg['username'], password=db_cfg['password'],
+                                 dsn=f"{db_cfg['host']}/{db_cfg['name']}", min=1,
+                                 max=db_cfg.get('pool_size', workers), increment=1, threaded=True,
+                                 getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT)
+
+
+def query_rows(pool, stmt, arraysize=update_nexrad.FETCH_ARRAYSIZE, prefetchrows=update_nexrad.FETCH_PREFETCH_ROWS):
+    """
+    run the query on a pooled connection and return a generator of its rows as dicts keyed by upper case column name.
+    The connection goes back to the pool once the rows are exhausted
+    """
+    connection = pool.acquire()
+    cursor = connection.cursor()
+    cursor.arraysize = arraysize
+    cursor.prefetchrows = prefetchrows
+    try:
+        cursor.execute(stmt)
+    except Exception:
+        pool.release(connection)
+        raise
+
+    columns = [column[0].upper() for column in cursor.description]
+
+    def rows():
+        try:
+            while True:
+                batch = cursor.fetchmany()
+                if not batch:
+                    return
+                for row in batch:
+                    yield dict(zip(columns, row))
+        finally:
+            pool.release(connection)
+
+    return rows()
+
+
+def sync_layer(geoplatform, pool, layer_cfg, cfg, dry_run=False):
+    """
+    apply the adds, updates and deletes needed to match a FeatureLayer to its query, matching features by the layer's
+    key field. Returns the counts and seconds taken
+    """
+    name = layer_cfg['name']
+    edit_cfg = cfg.get('edits', {})
+    db_cfg = cfg['database']
+
+    start = time.perf_counter()
+    gis_item = geoplatform.content.get(layer_cfg['item_id'])
+    if gis_item is None:
+        raise Exception(f"item {layer_cfg['item_id']} not found")
+    featurelayer = gis_item.layers[layer_cfg.get('layer', 0)]
+
+    # the layer is queried before a pooled connection is taken, so a failed layer query can't hold on to one
+    features = featurelayer.query(where="1=1", out_fields="*", return_geometry=True).features
+    rows = query_rows(pool, layer_cfg['query'], db_cfg.get('arraysize', update_nexrad.FETCH_ARRAYSIZE),
+                      db_cfg.get('prefetchrows', update_nexrad.FETCH_PREFETCH_ROWS))
+    adds, updates, deletes, row_count = get_layer_edits(features, rows, layer_cfg)
+    diff_seconds = time.perf_counter() - start
+    logging.info(f"{name}: {len(adds)} features to add, {len(updates)} to update, {len(deletes)} to delete")
+
+    report = {'rows': row_count, 'adds': 0, 'updates': 0, 'deletes': 0, 'diff_seconds': diff_seconds,
+              'edit_seconds': 0.0}
+    if dry_run:
+        logging.info(f"{name}: dry_run: skipping edits to FeatureLayer")
+        return report
+
+    start = time.perf_counter()
+    edits = [('adds', feature) for feature in adds] + [('updates', feature) for feature in updates] + \
+            [('deletes', oid) for oid in deletes]
+    counts = update_nexrad.edit_in_chunks(featurelayer, edits,
+                                          chunk_size=edit_cfg.get('chunk_size', update_nexrad.EDIT_CHUNK_SIZE),
+                                          workers=edit_cfg.get('workers', update_nexrad.EDIT_WORKERS),
+                                          retries=edit_cfg.get('retries', update_nexrad.EDIT_RETRIES),
+                                          key=layer_cfg['key'])
+    report.update(counts)
+    report['edit_seconds'] = time.perf_counter() - start
+    return report
+
+
+def get_layer_edits(features, rows, layer_cfg):
+    """
+    compare the query's rows with the layer's features by key field. Returns the Features to add, the Features to
+    update, the OBJECTIDs to delete and the number of rows
+    """
+    fields = layer_cfg['fields']
+    key = layer_cfg['key']
+
+    layer_features = {}
+    deletes = []
+    for feature in features:
+        key_value = feature.attributes[key]
+        if key_value in layer_features:
+            deletes.append(feature.attributes['OBJECTID'])
+        else:
+            layer_features[key_value] = feature
+
+    adds = []
+    updates = []
+    row_count = 0
+    for row, geom in project_rows(rows, layer_cfg):
+        row_count += 1
+        attributes = {field: row[column.upper()] for field, column in fields.items()}
+        existing = layer_features.pop(attributes[key], None)
+        if existing is None:
+            adds.append(Feature(geometry=geom, attributes=attributes))
+            continue
+
+        if update_nexrad.feature_hash(attributes, geom, fields) != \
+                update_nexrad.feature_hash(existing.attributes, existing.geometry, fields):
+            attributes['OBJECTID'] = existing.attributes['OBJECTID']
+            updates.append(Feature(geometry=geom, attributes=attributes))
+
+    # features left in the layer are no longer returned by the query
+    deletes.extend(feature.attributes['OBJECTID'] for feature in layer_features.values())
+    return adds, updates, deletes, row_count
+
+
+def project_rows(rows, layer_cfg, batch_size=update_nexrad.FETCH_ARRAYSIZE):
+    """yield (row, point geometry) for each row, projecting a batch of rows at a time"""
+    x_column = layer_cfg.get('x', 'LONGITUDE').upper()
+    y_column = layer_cfg.get('y', 'LATITUDE').upper()
+    in_sr = layer_cfg.get('in_sr', 4326)
+    out_sr = layer_cfg.get('out_sr', 3857)
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        geometries = [{'x': row[x_column], 'y': row[y_column]} for row in batch]
+        if in_sr != out_sr:
+            geometries = projection.project_geometries(geometries, in_sr=in_sr, out_sr=out_sr)
+        yield from zip(batch, geometries)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    main()
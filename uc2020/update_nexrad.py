@@ -2,18 +2,48 @@ import argparse
 import logging
 import cx_Oracle
 from arcgis.gis import GIS
-from arcgis import geometry
 from arcgis.features import Feature
-from arcgis import geometry
 import sys
 import datetime
+import calendar
+import decimal
+import hashlib
+import json
+import time
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import projection
 # import warnings
 # warnings.simplefilter(action='ignore', category=FutureWarning)
 
-def get_data_from_oracle(connect_string):
+# projected coordinates are compared to the centimeter, other floats to 6 decimal places
+GEOMETRY_PRECISION = 2
+ATTRIBUTE_PRECISION = 6
+
+# edits sent in each edit_features call, concurrent calls and attempts at each call
+EDIT_CHUNK_SIZE = 1000
+EDIT_WORKERS = 4
+EDIT_RETRIES = 3
+
+# rows fetched from the database in each round trip, and rows fetched along with the query's execution
+FETCH_ARRAYSIZE = 1000
+FETCH_PREFETCH_ROWS = 1000
+
+# FeatureLayer fields, in the order of the database query's columns
+STATION_FIELDS = ("STATION_ID", "STATION_NAME", "STATE", "BEGIN_DATE", "END_DATE", "COUNTY", "COUNTRY", "LATITUDE",
+                  "LONGITUDE", "ELEVATION", "OBJECTID")
+
+
+def get_data_from_oracle(connect_string, arraysize=FETCH_ARRAYSIZE, prefetchrows=FETCH_PREFETCH_ROWS):
+    """
+    run the station query and return a generator of its rows. The query runs before this returns, so a database error
+    is raised before any change is made to the FeatureLayer
+    """
 #    connection = cx_Oracle.connect('gis/VkYi9i8p6m6F@10.254.8.119/NCEIDEV')
     connection = cx_Oracle.connect(connect_string)
     cursor = connection.cursor()
+    cursor.arraysize = arraysize
+    cursor.prefetchrows = prefetchrows
     #cursor.execute("select * from  GIS.NEXRAD_ODA")
     stmt = """SELECT
        'NEXRAD:' || icaoid station_id,
@@ -29,15 +59,41 @@ def get_data_from_oracle(connect_string):
         rownum objectid
     FROM homrselect.rpt_mshr_legacy
     WHERE STNTYPE in ('NEXRAD','TDWR') AND icaoid != 'KCRI'"""
-    cursor.execute(stmt)
-    return cursor.fetchall()
+    try:
+        cursor.execute(stmt)
+    except Exception:
+        connection.close()
+        raise
+    return fetch_rows(connection, cursor)
+
+
+def fetch_rows(connection, cursor):
+    """yield each row of the executed query, fetching arraysize rows at a time, then close the connection"""
+    try:
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                return
+            yield from rows
+    finally:
+        connection.close()
+
+
+def project_rows(nexrad_data, batch_size=FETCH_ARRAYSIZE):
+    """yield (station, projected geometry) for each row, projecting a batch of rows at a time"""
+    nexrad_data = iter(nexrad_data)
+    while True:
+        batch = list(islice(nexrad_data, batch_size))
+        if not batch:
+            return
+        yield from zip(batch, project_all_geometries(batch))
 
 
 def project_all_geometries(nexrad_data):
     geometries = [{'y': i[7], 'x': i[8]} for i in nexrad_data]
 
-    # ArcGIS Online seems to be expecting coordinates in WebMercator
-    projected_geometries = geometry.project(geometries=geometries, in_sr=4326, out_sr=3857, gis=geoplatform)
+    # ArcGIS Online seems to be expecting coordinates in WebMercator. projected locally, no geometry service round trip
+    projected_geometries = projection.project_geometries(geometries, in_sr=4326, out_sr=3857)
     return projected_geometries
 
 
@@ -52,60 +108,222 @@ def delete_from_featurelayer(featurelayer):
         raise RuntimeError("Expected the FeatureLayer to be empty")
 
 
-def add_features_to_featurelayer(featurelayer, nexrad_data):
+def add_features_to_featurelayer(featurelayer, nexrad_data, chunk_size=EDIT_CHUNK_SIZE, workers=EDIT_WORKERS,
+                                 retries=EDIT_RETRIES):
     """add each record retrieved from the database as a new Feature"""
-    # much faster to project all points at once
-    geometries = project_all_geometries(nexrad_data)
-
-    new_features = []
-    for station, geom in zip(nexrad_data, geometries):
-        logging.info(f"adding station {station[1]}...")
-
-        new_features.append(
-            Feature(geometry=geom, attributes={
-                "STATION_ID": station[0],
-                "STATION_NAME": station[1],
-                "STATE": station[2],
-                "BEGIN_DATE": station[3],
-                "END_DATE": station[4],
-                "COUNTY": station[5],
-                "COUNTRY": station[6],
-                "LATITUDE": station[7],
-                "LONGITUDE": station[8],
-                "ELEVATION": station[9],
-                "OBJECTID": station[10]
-            })
-        )
+    station_count = 0
+
+    # rows are projected in batches and Features built as each chunk is sent rather than all up front
+    def new_features():
+        nonlocal station_count
+        for station, geom in project_rows(nexrad_data):
+            station_count += 1
+            logging.debug(f"adding station {station[1]}...")
+            yield 'adds', Feature(geometry=geom, attributes=station_attributes(station))
 
     # commit changes to the hosted FeatureLayer
-    result = featurelayer.edit_features(adds=new_features)
-    added_count = len(result['addResults'])
+    counts = edit_in_chunks(featurelayer, new_features(), chunk_size, workers, retries, key='STATION_ID')
+    added_count = counts['adds']
+    logging.info(f"retrieved {station_count} stations from database")
     logging.info(f"added {added_count} stations")
-    if added_count != len(nexrad_data):
+    if added_count != station_count:
         raise RuntimeError("Number of records added to FeatureLayer does not equal the record count from database")
 
 
+def edit_in_chunks(featurelayer, edits, chunk_size=EDIT_CHUNK_SIZE, workers=EDIT_WORKERS, retries=EDIT_RETRIES,
+                   key=None):
+    """
+    apply an iterable of ('adds' | 'updates' | 'deletes', Feature or OBJECTID) edits in edit_features calls of at most
+    chunk_size edits, with up to `workers` calls in flight. Returns the number of each kind of edit applied. key is the
+    field identifying a Feature, needed to retry a chunk of adds after a failed call
+    """
+    counts = {'adds': 0, 'updates': 0, 'deletes': 0}
+    edits = iter(edits)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        while True:
+            chunk = list(islice(edits, chunk_size))
+            if chunk:
+                in_flight.add(executor.submit(edit_chunk, featurelayer, chunk, retries, key))
+            # only as many chunks as workers are built and waiting, so memory use doesn't grow with the layer
+            if in_flight and (len(in_flight) >= workers or not chunk):
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for kind, count in future.result().items():
+                        counts[kind] += count
+            if not chunk and not in_flight:
+                return counts
+
+
+def edit_chunk(featurelayer, chunk, retries=EDIT_RETRIES, key=None):
+    """
+    send one chunk of edits, retrying when the call fails or not every edit succeeds. The chunk is rolled back on
+    failure, so it can be sent again whole. A call which raised, e.g. on a read timeout, may still have been applied, so
+    before a chunk with adds is sent again the layer is checked for them by key. Without a key it isn't sent again
+    """
+    edits = {'adds': [], 'updates': [], 'deletes': []}
+    for kind, item in chunk:
+        edits[kind].append(item)
+
+    maybe_applied = False
+    for attempt in range(1, retries + 1):
+        try:
+            if maybe_applied and edits['adds']:
+                # the edits are applied all or nothing, so one add in the layer means the whole chunk was
+                if find_added(featurelayer, edits['adds'], key):
+                    return {kind: len(items) for kind, items in edits.items()}
+                maybe_applied = False
+            result = featurelayer.edit_features(adds=edits['adds'] or None, updates=edits['updates'] or None,
+                                                deletes=','.join(str(oid) for oid in edits['deletes']) or None,
+                                                rollback_on_failure=True)
+            counts = {kind: sum(1 for item in result.get(kind[:-1] + 'Results', []) if item.get('success'))
+                      for kind in edits}
+            if counts == {kind: len(items) for kind, items in edits.items()}:
+                return counts
+            error = f"{counts} of {len(chunk)} edits succeeded"
+        except Exception as e:
+            error = e
+            maybe_applied = True
+            if edits['adds'] and key is None:
+                raise RuntimeError(f"failed to apply a chunk of {len(chunk)} edits, which may have been applied: {e}")
+
+        if attempt == retries:
+            raise RuntimeError(f"failed to apply a chunk of {len(chunk)} edits after {retries} attempts: {error}")
+        logging.warning(f"attempt {attempt} to apply a chunk of {len(chunk)} edits failed, retrying: {error}")
+        time.sleep(2 ** attempt)
+
+
+def find_added(featurelayer, adds, key):
+    """return the key values of the Features to add which are already in the layer"""
+    values = [feature.attributes[key] for feature in adds]
+    literals = [str(value) if isinstance(value, (int, float)) else "'" + str(value).replace("'", "''") + "'"
+                for value in values]
+    features = featurelayer.query(where=f"{key} IN ({', '.join(literals)})", out_fields=key,
+                                  return_geometry=False).features
+    return {feature.attributes[key] for feature in features}
+
+
+def station_attributes(station):
+    return dict(zip(STATION_FIELDS, station))
+
+
+def normalize_value(value):
+    """put a database or FeatureLayer value in a common form: dates as epoch milliseconds and rounded floats"""
+    if isinstance(value, datetime.datetime):
+        # naive database dates are stored as UTC by the FeatureLayer
+        value = calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+    elif isinstance(value, datetime.date):
+        value = calendar.timegm(value.timetuple()) * 1000
+    if isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool):
+        # the database may return 12 where the FeatureLayer has 12.0
+        return round(float(value), ATTRIBUTE_PRECISION)
+    if isinstance(value, str):
+        return value.strip() or None
+    return value
+
+
+def feature_hash(attributes, geom, fields=STATION_FIELDS):
+    """
+    hash of a station's attributes and point geometry. OBJECTID is assigned by the FeatureLayer and any other fields
+    it adds aren't from the database, so they're left out
+    """
+    attributes = {key.upper(): value for key, value in attributes.items()}
+    normalized = {field.upper(): normalize_value(attributes.get(field.upper())) for field in fields
+                  if field.upper() != 'OBJECTID'}
+    normalized['SHAPE'] = [round(float(geom['x']), GEOMETRY_PRECISION), round(float(geom['y']), GEOMETRY_PRECISION)]
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_layer_stations(featurelayer):
+    """return {STATION_ID: Feature} of the stations in the FeatureLayer and the OBJECTIDs of any duplicates"""
+    stations = {}
+    duplicates = []
+    for feature in featurelayer.query(where="1=1", out_fields="*", return_geometry=True).features:
+        station_id = feature.attributes['STATION_ID']
+        if station_id in stations:
+            duplicates.append(feature.attributes['OBJECTID'])
+        else:
+            stations[station_id] = feature
+    return stations, duplicates
+
+
+def get_station_edits(featurelayer, nexrad_data):
+    """
+    compare the database records with the stations in the FeatureLayer by STATION_ID. Returns the Features to add, the
+    Features to update and the OBJECTIDs to delete
+    """
+    layer_stations, deletes = get_layer_stations(featurelayer)
+
+    adds = []
+    updates = []
+    station_count = 0
+    for station, geom in project_rows(nexrad_data):
+        station_count += 1
+        attributes = station_attributes(station)
+        station_id = attributes['STATION_ID']
+        existing = layer_stations.pop(station_id, None)
+        if existing is None:
+            logging.debug(f"adding station {station_id}")
+            adds.append(Feature(geometry=geom, attributes=attributes))
+            continue
+
+        if feature_hash(attributes, geom) != feature_hash(existing.attributes, existing.geometry):
+            logging.debug(f"updating station {station_id}")
+            attributes['OBJECTID'] = existing.attributes['OBJECTID']
+            updates.append(Feature(geometry=geom, attributes=attributes))
+
+    # stations left in the FeatureLayer are no longer in the database
+    for station_id, feature in layer_stations.items():
+        logging.debug(f"deleting station {station_id}")
+        deletes.append(feature.attributes['OBJECTID'])
+
+    logging.info(f"retrieved {station_count} stations from database")
+    return adds, updates, deletes
+
+
+def sync_featurelayer(featurelayer, nexrad_data, dry_run=False, chunk_size=EDIT_CHUNK_SIZE, workers=EDIT_WORKERS,
+                      retries=EDIT_RETRIES):
+    """
+    apply only the adds, updates and deletes needed to match the FeatureLayer to the database, in a single edit unless
+    there are more than chunk_size
+    """
+    adds, updates, deletes = get_station_edits(featurelayer, nexrad_data)
+    logging.info(f"{len(adds)} stations to add, {len(updates)} to update, {len(deletes)} to delete")
+    if dry_run:
+        logging.info("dry_run: skipping edits to FeatureLayer")
+        return
+
+    edits = [('adds', feature) for feature in adds] + [('updates', feature) for feature in updates] + \
+            [('deletes', oid) for oid in deletes]
+    counts = edit_in_chunks(featurelayer, edits, chunk_size, workers, retries, key='STATION_ID')
+    logging.info(f"added {counts['adds']}, updated {counts['updates']} and deleted {counts['deletes']} stations")
+
+
 def main(args):
     if args.dry_run:
         logging.info('dry_run mode: no changes will be made')
 
     oracle_connect_string = f"{args.db_username}/{args.db_password}@{args.db_host}/{args.db_name}"
-    nexrad_data = get_data_from_oracle(oracle_connect_string)
-    logging.info(f"retrieved {len(nexrad_data)} stations from database")
+    nexrad_data = get_data_from_oracle(oracle_connect_string, args.arraysize, args.prefetchrows)
 
     # this FeatureLayerCollection has a single FeatureLayer
     gis_item = geoplatform.content.get('b9c527e0cb6d4c7fac39981f966fdd65')
     layer = gis_item.layers[0]
 
+    if not args.full_reload:
+        sync_featurelayer(layer, nexrad_data, args.dry_run, args.chunk_size, args.edit_workers, args.edit_retries)
+        return
+
     if args.dry_run:
         logging.info("dry_run: skipping delete from FeatureLayer")
     else:
         delete_from_featurelayer(layer)
 
     if args.dry_run:
+        logging.info(f"retrieved {sum(1 for _ in nexrad_data)} stations from database")
         logging.info("dry_run: skipping add stations to FeatureLayer")
     else:
-        add_features_to_featurelayer(layer, nexrad_data)
+        add_features_to_featurelayer(layer, nexrad_data, args.chunk_size, args.edit_workers, args.edit_retries)
 
 
 if __name__ == "__main__":
@@ -120,6 +338,16 @@ if __name__ == "__main__":
     arg_parser.add_argument("--db_host", default="10.254.8.119", help="DB hostname or IP")
     arg_parser.add_argument("--db_name", default="NCEIDEV", help="Oracle instance name")
     arg_parser.add_argument("--dry_run", help="query database but no changes made to FeatureLayer", action="store_true")
+    arg_parser.add_argument("--full_reload", action="store_true",
+                            help="delete every station and add them all again rather than only applying the changes")
+    arg_parser.add_argument("--arraysize", type=int, default=FETCH_ARRAYSIZE,
+                            help="number of rows fetched from the database in each round trip")
+    arg_parser.add_argument("--prefetchrows", type=int, default=FETCH_PREFETCH_ROWS,
+                            help="number of rows fetched when the query is executed")
+    arg_parser.add_argument("--chunk_size", type=int, default=EDIT_CHUNK_SIZE,
+                            help="maximum number of features sent in each edit")
+    arg_parser.add_argument("--edit_workers", type=int, default=EDIT_WORKERS, help="number of concurrent edits")
+    arg_parser.add_argument("--edit_retries", type=int, default=EDIT_RETRIES, help="attempts at each edit")
     args = arg_parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
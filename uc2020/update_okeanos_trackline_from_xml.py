@@ -6,19 +6,34 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 
 import xml.etree.ElementTree as ET
 from arcgis.gis import GIS
-from arcgis import geometry
+from arcgis.features import Feature
 import yaml
-import sys
-
-with open("update_okeanos_position.yml", 'r') as yaml_file:
-    cfg = yaml.safe_load(yaml_file)
+import os
+import time
+import argparse
+import logging
+import json
+import datetime
+from itertools import islice
+import projection
 
 BASE_PATH = '/data/OkeanosExplorer/'
 #BASE_PATH = 'E:/nobackup/tmp/OkeanosExplorer/'
 
-username = cfg['geoplatform']['username']
-password = cfg['geoplatform']['password']
-geoplatform = GIS("https://noaa.maps.arcgis.com", username, password)
+# this feature layer has a single layer with a single feature
+POSITION_ITEM_ID = '4bcb226ce9c446fc802cc7f5c29bcc5c'
+
+# a new marker with the same attributes within this many degrees of the last position isn't sent
+POSITION_TOLERANCE = 0.0001
+
+# attributes which change with every marker, so they're not compared when deciding whether to send an update
+VOLATILE_ATTRIBUTES = ('dateTime',)
+
+# markers sent in each edit_features call when appending to the trackline
+TRACKLINE_BATCH_SIZE = 500
+
+# connection to the NOAA GeoPlatform, set in main
+geoplatform = None
 
 
 def get_cruise_list(cruise_list_file):
@@ -33,18 +48,53 @@ def get_cruise_list(cruise_list_file):
     return cruises
 
 
+def get_current_cruise(cruise_list):
+    """return the current cruise and whether the ship is in port"""
+    # assume current cruise is first in list
+    if cruise_list[0]['id'] != 'NO CURRENT CRUISE':
+        return cruise_list[0], False
+
+    # print('WARNING: the ship is in port')
+    return cruise_list[1], True
+
+
 def get_current_marker(cruise):
     # cruise is just a dictionary of the attributes on the XML <cruise> element
-    markers = []
-
     cruise_pts_file = BASE_PATH + cruise['hourly_path']
-    tree = ET.parse(cruise_pts_file).getroot()
 
-    for marker in tree:
-        markers.append(marker.attrib)
+    # assume markers listed in reverse chronological order, so only the first is read
+    markers = iter_markers(cruise_pts_file)
+    try:
+        marker = next(markers, None)
+    finally:
+        markers.close()
+
+    if marker is None:
+        raise Exception(f"no markers in {cruise_pts_file}")
+    return marker
+
+
+def iter_markers(cruise_pts_file):
+    """
+    yield the attributes of each marker element in turn. The file is parsed only as far as it's read and elements are
+    freed once read, so memory use doesn't grow with the file
+    """
+    with open(cruise_pts_file, 'rb') as xml_file:
+        depth = 0
+        root = None
+        for event, element in ET.iterparse(xml_file, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = element
+                elif depth == 2:
+                    # attributes are complete at the start tag
+                    yield dict(element.attrib)
+            else:
+                depth -= 1
+                if depth == 1:
+                    root.clear()
 
-    # assume markers listed in reverse chronological order
-    return markers[0]
 
 def write_csv_file(marker, csv_file):
     f = open(csv_file, 'w')
@@ -55,21 +105,16 @@ def write_csv_file(marker, csv_file):
     f.close()
 
 
-def update_gis_item(marker, in_port=False):
-    # marker is just a dictionary of the attributes on the XML <marker> element
-
-    # this feature layer has a single layer with a single feature
-    gis_item = geoplatform.content.get('4bcb226ce9c446fc802cc7f5c29bcc5c')
-    point = gis_item.layers[0].query().features[0]
-
-    point.attributes['IN_PORT'] = in_port
+def get_position_layer():
+    gis_item = geoplatform.content.get(POSITION_ITEM_ID)
+    return gis_item.layers[0]
 
-    # extract the lat, lon from dictionary and create geometry
-    #lon = marker.pop('lon')
-    #lat = marker.pop('lat')
 
-    geom = geographic_to_web_mercator(marker['lon'], marker['lat'])
-    point.geometry = geom
+def position_attributes(marker, in_port=False):
+    """return the attributes of the position Feature for a marker"""
+    # marker is just a dictionary of the attributes on the XML <marker> element
+    marker = dict(marker)
+    attributes = {'IN_PORT': in_port}
 
     # leave the lon, lat values as attributes for convenience
     marker['lon'] = round(float(marker['lon']), 5)
@@ -82,73 +127,299 @@ def update_gis_item(marker, in_port=False):
                 #If in port, set all attributes to null except cruiseID, lon, lat, and dateTime
                 marker[key] = None
 
-    # previous_position = web_mercator_to_geographic(point.geometry['x'], point.geometry['y'])
-    # print(f"Okeanos Explorer previously at {previous_position[0]['x']}, {previous_position[0]['y']}")
-    # print(f"Okeanos Explorer currently at {lon}, {lat}")
-
     # copy the remaining attributes from the XML <marker> element to the Feature
     for key in marker:
         value = marker[key]
         # print(f"{key} = {value}")
         if value:
-            point.attributes[key] = marker[key]
+            attributes[key] = marker[key]
         else:
-            point.attributes[key] = None
+            attributes[key] = None
+
+    return attributes
+
+
+def position_changed(previous, current, tolerance=POSITION_TOLERANCE):
+    """whether the position moved beyond the tolerance or any other attribute changed"""
+    for key in ('lon', 'lat'):
+        if previous.get(key) is None or abs(float(previous[key]) - float(current[key])) >= tolerance:
+            return True
+
+    for key, value in current.items():
+        if key in ('lon', 'lat') or key in VOLATILE_ATTRIBUTES:
+            continue
+        if values_differ(previous.get(key), value):
+            return True
+    return False
+
+
+def values_differ(previous, current):
+    # the layer may hold a number where the XML has a string
+    if previous is None or current is None:
+        return (previous is None) != (current is None)
+    try:
+        return float(previous) != float(current)
+    except (TypeError, ValueError):
+        return str(previous) != str(current)
 
-    result = gis_item.layers[0].edit_features(updates=[point])
+
+def update_gis_item(marker, in_port=False, layer=None, point=None):
+    """
+    send the marker's position and attributes to the position Feature, returning the updated Feature. The layer and
+    its Feature are fetched unless given
+    """
+    if layer is None:
+        layer = get_position_layer()
+    if point is None:
+        point = layer.query().features[0]
+
+    point.attributes.update(position_attributes(marker, in_port))
+
+    # previous_position = web_mercator_to_geographic(point.geometry['x'], point.geometry['y'])
+    # print(f"Okeanos Explorer previously at {previous_position[0]['x']}, {previous_position[0]['y']}")
+    # print(f"Okeanos Explorer currently at {lon}, {lat}")
+
+    point.geometry = geographic_to_web_mercator(marker['lon'], marker['lat'])
+
+    result = layer.edit_features(updates=[point])
 
     # should be exactly one updated Feature
     if not result['updateResults'][0]['success']:
         raise Exception("error updating current position")
 
+    return point
+
 
 def geographic_to_web_mercator(lon, lat):
     input_geometry = {'y': float(lat),
                       'x': float(lon)}
-    output_geometry = geometry.project(geometries=[input_geometry],
-                                       in_sr=4326,
-                                       out_sr=3857,
-                                       gis=geoplatform)
+    output_geometry = projection.project_geometries([input_geometry], in_sr=4326, out_sr=3857)
     return output_geometry[0]
 
 
 def web_mercator_to_geographic(x, y):
     input_geometry = {'y': float(y),
                       'x': float(x)}
-    output_geometry = geometry.project(geometries=[input_geometry],
-                                       in_sr=3857,
-                                       out_sr=4326,
-                                       gis=geoplatform)
+    output_geometry = projection.project_geometries([input_geometry], in_sr=3857, out_sr=4326)
     return output_geometry[0]
 
 
-def main():
-    in_port = False
-
-    if len(sys.argv) != 3:
-        print(f"Usage: {sys.argv[0]} <cruise list filename> <csv filename>")
-        sys.exit(1)
-
-    cruise_list_file = sys.argv[1]
-    csv_file = sys.argv[2]
-
+def sync_position(cruise_list_file, csv_file, state, tolerance=POSITION_TOLERANCE, refresh=None):
+    """
+    update the position Feature from the current cruise's latest marker when it differs from the last position sent,
+    or when the position was sent at least refresh seconds ago. state holds the layer handle, the Feature as last sent
+    and when it was sent, and is kept between calls
+    """
     cruise_list = get_cruise_list(cruise_list_file)
-    if cruise_list[0]['id'] != 'NO CURRENT CRUISE':
-        current_cruise = cruise_list[0]
-    else:
-        current_cruise = cruise_list[1]
-        in_port = True
-        # print('WARNING: the ship is in port')
+    current_cruise, in_port = get_current_cruise(cruise_list)
 
-    # assume current cruise is first in list and first Marker element is most recent
+    # first Marker element is most recent
     marker = get_current_marker(current_cruise)
 
     # temporarily write out CSV file
     write_csv_file(marker, csv_file)
 
+    if state.get('layer') is None:
+        state['layer'] = get_position_layer()
+        state['point'] = state['layer'].query().features[0]
+        state['updated_at'] = sent_at(state['point'].attributes)
+
+    stale = refresh is not None and time.time() - state['updated_at'] >= refresh
+    if not stale and not position_changed(state['point'].attributes, position_attributes(marker, in_port), tolerance):
+        logging.debug(f"position unchanged at {marker['lon']}, {marker['lat']}")
+        return False
+
     # update the hosted Feature from the XML element
-    update_gis_item(marker, in_port)
+    state['point'] = update_gis_item(marker, in_port, state['layer'], state['point'])
+    state['updated_at'] = time.time()
+    logging.info(f"updated position to {marker['lon']}, {marker['lat']}")
+    return True
+
+
+def sent_at(attributes):
+    """
+    seconds since the epoch of the dateTime of a position Feature fetched from the layer, or 0 when it doesn't parse so
+    the position is refreshed
+    """
+    try:
+        date_time = datetime.datetime.fromisoformat(attributes['dateTime'].replace('Z', '+00:00'))
+    except (KeyError, AttributeError, ValueError):
+        return 0
+    # marker times without an offset are UTC
+    if date_time.tzinfo is None:
+        date_time = date_time.replace(tzinfo=datetime.timezone.utc)
+    return date_time.timestamp()
+
+
+def watched_mtimes(cruise_list_file):
+    """modification times of the cruise list and the current cruise's marker file"""
+    current_cruise, _ = get_current_cruise(get_cruise_list(cruise_list_file))
+    return os.stat(cruise_list_file).st_mtime_ns, os.stat(BASE_PATH + current_cruise['hourly_path']).st_mtime_ns
+
+
+def append_trackline(cruise_list_file, trackline, state):
+    """
+    append the current cruise's markers newer than its watermark to the trackline layer, oldest first. The watermark,
+    the dateTime of the newest marker sent, is saved after each batch so an interrupted run doesn't send markers twice.
+    state holds the layer handle and is kept between calls. Returns the number of markers appended
+    """
+    current_cruise, in_port = get_current_cruise(get_cruise_list(cruise_list_file))
+    if in_port:
+        logging.debug("in port, no trackline to append to")
+        return 0
+
+    watermarks = load_watermarks(trackline['watermark_file'])
+    cruise_id = current_cruise['id']
+    watermark = watermarks.get(cruise_id)
+
+    # markers are in reverse chronological order, so reading stops at the first one already sent
+    new_markers = []
+    for marker in iter_markers(BASE_PATH + current_cruise['hourly_path']):
+        if watermark is not None and not is_newer(marker['dateTime'], watermark):
+            break
+        new_markers.append(marker)
+    if not new_markers:
+        logging.debug(f"no new markers for cruise {cruise_id}")
+        return 0
+
+    if state.get('layer') is None:
+        gis_item = geoplatform.content.get(trackline['item_id'])
+        state['layer'] = gis_item.layers[trackline.get('layer', 0)]
+
+    new_markers.reverse()
+    markers = iter(new_markers)
+    while True:
+        batch = list(islice(markers, trackline.get('batch_size', TRACKLINE_BATCH_SIZE)))
+        if not batch:
+            break
+
+        features = [Feature(geometry=geographic_to_web_mercator(marker['lon'], marker['lat']),
+                            attributes=trackline_attributes(marker)) for marker in batch]
+        # a batch is added all or nothing, so the watermark never falls behind markers already in the layer
+        result = state['layer'].edit_features(adds=features, rollback_on_failure=True)
+        if sum(1 for item in result['addResults'] if item.get('success')) != len(batch):
+            raise Exception(f"error appending {len(batch)} markers to the trackline")
+
+        watermarks[cruise_id] = batch[-1]['dateTime']
+        save_watermarks(trackline['watermark_file'], watermarks)
+
+    logging.info(f"appended {len(new_markers)} markers to the trackline of cruise {cruise_id}")
+    return len(new_markers)
+
+
+def trackline_attributes(marker):
+    attributes = position_attributes(marker)
+    del attributes['IN_PORT']
+    return attributes
+
+
+def is_newer(date_time, watermark):
+    # timestamps are compared as dates when both parse as ISO 8601, otherwise as strings
+    try:
+        return datetime.datetime.fromisoformat(date_time.replace('Z', '+00:00')) > \
+            datetime.datetime.fromisoformat(watermark.replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return date_time > watermark
+
+
+def load_watermarks(watermark_file):
+    """return {cruise id: dateTime of the newest marker appended to the trackline}"""
+    try:
+        with open(watermark_file, 'r') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_watermarks(watermark_file, watermarks):
+    # write a temporary file and rename it, so a crash never leaves a truncated watermark file
+    with open(watermark_file + '.tmp', 'w') as json_file:
+        json.dump(watermarks, json_file, indent=2)
+    os.replace(watermark_file + '.tmp', watermark_file)
+
+
+def run_daemon(cruise_list_file, csv_file, interval=60, tolerance=POSITION_TOLERANCE, refresh=3600, trackline=None):
+    """
+    poll the cruise list and marker files, updating the position, and the trackline if given, when either is modified.
+    The GIS connection and layer handles are kept between updates
+    """
+    state = {}
+    trackline_state = {}
+    mtimes = None
+    trackline_mtimes = None
+    while True:
+        try:
+            current_mtimes = watched_mtimes(cruise_list_file)
+            stale = state.get('updated_at') is not None and time.time() - state['updated_at'] >= refresh
+            if current_mtimes != mtimes or stale:
+                sync_position(cruise_list_file, csv_file, state, tolerance, refresh)
+                mtimes = current_mtimes
+        except Exception as e:
+            logging.error(f"error updating current position: {e}")
+            # fetch the layer again in case the handle has gone bad
+            state = {}
+
+        if trackline:
+            try:
+                current_mtimes = watched_mtimes(cruise_list_file)
+                if current_mtimes != trackline_mtimes:
+                    append_trackline(cruise_list_file, trackline, trackline_state)
+                    trackline_mtimes = current_mtimes
+            except Exception as e:
+                logging.error(f"error appending to the trackline: {e}")
+                trackline_state = {}
+
+        time.sleep(interval)
+
+
+def main():
+    global geoplatform
+
+    # setup command line arguments
+    arg_parser = argparse.ArgumentParser(
+        description="""update the Okeanos Explorer's position Feature from its cruise XML files"""
+    )
+    arg_parser.add_argument("cruise_list_file", help="XML list of cruises, the current cruise first")
+    arg_parser.add_argument("csv_file", help="file the current marker is written to")
+    arg_parser.add_argument("--config", default="update_okeanos_position.yml",
+                            help="YAML file of GeoPlatform credentials")
+    arg_parser.add_argument("--daemon", action="store_true",
+                            help="keep running, updating the position whenever the XML files are modified")
+    arg_parser.add_argument("--interval", type=float, default=60, help="seconds between checks of the XML files")
+    arg_parser.add_argument("--tolerance", type=float, default=POSITION_TOLERANCE,
+                            help="degrees the ship must move before the position is updated")
+    arg_parser.add_argument("--refresh", type=float, default=3600,
+                            help="update the position at least this often in seconds, even when unchanged, so its "
+                                 "dateTime stays current. outside daemon mode, compared with the layer's dateTime")
+    arg_parser.add_argument("--trackline", action="store_true",
+                            help="also append new markers to the trackline layer given by trackline: item_id in the "
+                                 "config file")
+    arg_parser.add_argument("--watermark_file", default="okeanos_trackline_watermark.json",
+                            help="file recording the newest marker appended to the trackline of each cruise")
+    args = arg_parser.parse_args()
+
+    with open(args.config, 'r') as yaml_file:
+        cfg = yaml.safe_load(yaml_file)
+
+    username = cfg['geoplatform']['username']
+    password = cfg['geoplatform']['password']
+    geoplatform = GIS("https://noaa.maps.arcgis.com", username, password)
+
+    trackline = None
+    if args.trackline:
+        if 'trackline' not in cfg:
+            raise Exception(f"--trackline requires a trackline: item_id entry in {args.config}")
+        trackline = dict(cfg['trackline'], watermark_file=args.watermark_file)
+
+    if args.daemon:
+        run_daemon(args.cruise_list_file, args.csv_file, args.interval, args.tolerance, args.refresh, trackline)
+    else:
+        sync_position(args.cruise_list_file, args.csv_file, {}, args.tolerance, args.refresh)
+        if trackline:
+            append_trackline(args.cruise_list_file, trackline, {})
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
     main()
@@ -35,6 +35,17 @@ def main(args):
             continue
 
 
+def load_targets(filename):
+    """read a JSON list of {"name": service name, "antialiasing": mode}, e.g. as written by antialiasing_tuner.py"""
+    with open(filename, 'r') as json_file:
+        targets = json.load(json_file)
+
+    for target in targets:
+        if 'name' not in target or 'antialiasing' not in target:
+            raise Exception(f"each entry in {filename} needs a name and an antialiasing mode")
+    return targets
+
+
 def get_token(username, password, servername):
     url = f"https://{servername}:6443/arcgis/admin/generateToken"
     params = urlencode({'username': username, 'password': password, 'client': 'requestip', 'f': 'json'})
@@ -206,6 +217,10 @@ if __name__ == "__main__":
     arg_parser.add_argument("username", help="user name")
     arg_parser.add_argument("password", help="password")
     arg_parser.add_argument("server", help="fully qualified server name")
+    arg_parser.add_argument("--targets", help="JSON file of the services and modes to set, replacing the built-in list")
     args = arg_parser.parse_args()
 
+    if args.targets:
+        target_services = load_targets(args.targets)
+
     main(args)